@@ -1,9 +1,18 @@
 import csv
+import filecmp
+import json
 import os
 import re
-import shutil
+from array import array
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
+from bic_util.checksum import hash_file_sha256
+from bic_util.fs import LinkMode, copy_file_link
+from bic_util.print import get_file_size_progress_printer
+from bic_util.util import map_bounded
+
 
 @dataclass
 class BidsSession:
@@ -15,83 +24,288 @@ class BidsSession:
     session: str
 
 
-def get_bids_sessions(bids_path: str) -> list[BidsSession]:
+_SUBJECT_DIR_REGEX = re.compile(r'^sub-(.+)')
+_SESSION_DIR_REGEX = re.compile(r'^ses-(.+)')
+
+
+@dataclass
+class BidsDataset:
     """
-    Get the list of subject and session pairs present in a BIDS dataset.
+    The subject and session labels of a BIDS dataset, scanned once and refreshed incrementally
+    using the modification times of its directories.
     """
 
-    bids_sessions: list[BidsSession] = []
+    path: str
+    """
+    Path of the BIDS dataset.
+    """
 
-    for file_1 in os.scandir(bids_path):
-        subject_match = re.search(r'^sub-(.*)', file_1.name)
-        if not subject_match:
-            continue
+    subject_sessions: dict[str, set[str]]
+    """
+    Session labels of each subject of the dataset, keyed by subject label.
+    """
+
+    dir_mtimes: dict[str, int]
+    """
+    Modification times of the dataset directory, keyed by an empty string, and of each subject
+    directory, keyed by subject label, at the time of their last scan.
+    """
 
-        if not os.path.isdir(file_1.path):
+
+def scan_bids_dataset(bids_path: str) -> BidsDataset:
+    """
+    Scan the subjects and sessions of a BIDS dataset.
+    """
+
+    bids_dataset = BidsDataset(bids_path, {}, {})
+    refresh_bids_dataset(bids_dataset)
+    return bids_dataset
+
+
+def refresh_bids_dataset(bids_dataset: BidsDataset):
+    """
+    Update the subjects and sessions of a scanned BIDS dataset. Only the directories whose
+    modification time changed since the last scan are listed again.
+    """
+
+    dataset_mtime = os.stat(bids_dataset.path).st_mtime_ns
+    if bids_dataset.dir_mtimes.get('') != dataset_mtime:
+        subject_labels: set[str] = set()
+        with os.scandir(bids_dataset.path) as iterator:
+            for entry in iterator:
+                subject_match = _SUBJECT_DIR_REGEX.match(entry.name)
+                if subject_match and entry.is_dir():
+                    subject_labels.add(subject_match.group(1))
+
+        for subject_label in bids_dataset.subject_sessions.keys() - subject_labels:
+            del bids_dataset.subject_sessions[subject_label]
+            del bids_dataset.dir_mtimes[subject_label]
+
+        for subject_label in subject_labels - bids_dataset.subject_sessions.keys():
+            bids_dataset.subject_sessions[subject_label] = set()
+
+        bids_dataset.dir_mtimes[''] = dataset_mtime
+
+    for subject_label, session_labels in bids_dataset.subject_sessions.items():
+        subject_dir_path = os.path.join(bids_dataset.path, f'sub-{subject_label}')
+        subject_mtime = os.stat(subject_dir_path).st_mtime_ns
+        if bids_dataset.dir_mtimes.get(subject_label) == subject_mtime:
             continue
 
-        for file_2 in os.scandir(file_1.path):
-            session_match = re.search(r'ses-(.*)', file_2.name)
-            if not session_match:
-                continue
+        session_labels.clear()
+        with os.scandir(subject_dir_path) as iterator:
+            for entry in iterator:
+                session_match = _SESSION_DIR_REGEX.match(entry.name)
+                if session_match and entry.is_dir():
+                    session_labels.add(session_match.group(1))
 
-            if not os.path.isdir(file_2.path):
-                continue
+        bids_dataset.dir_mtimes[subject_label] = subject_mtime
+
+
+def get_bids_dataset_sessions(bids_dataset: BidsDataset) -> list[BidsSession]:
+    """
+    Get the list of subject and session pairs of a scanned BIDS dataset, sorted by subject and
+    session labels.
+    """
+
+    return [
+        BidsSession(subject_label, session_label)
+        for subject_label in sorted(bids_dataset.subject_sessions)
+        for session_label in sorted(bids_dataset.subject_sessions[subject_label])
+    ]
+
+
+def has_bids_dataset_session(bids_dataset: BidsDataset, bids_session: BidsSession) -> bool:
+    """
+    Check whether a subject and session pair exists in a scanned BIDS dataset, without accessing
+    the file system.
+    """
+
+    session_labels = bids_dataset.subject_sessions.get(bids_session.subject)
+    return session_labels is not None and bids_session.session in session_labels
+
+
+def get_bids_sessions(bids_path: str) -> list[BidsSession]:
+    """
+    Get the list of subject and session pairs present in a BIDS dataset.
+    """
 
-            bids_sessions.append(BidsSession(
-                subject = subject_match.group(1),
-                session = session_match.group(1),
-            ))
+    return get_bids_dataset_sessions(scan_bids_dataset(bids_path))
 
-    return bids_sessions
 
+BIDS_SYNC_MANIFEST_FILE_NAME = '.bic_util_sync_manifest.tsv'
+"""
+Name of the manifest file written by `sync_bids_sessions` in the output BIDS dataset.
+"""
 
-def copy_bids_sessions(input_bids_path: str, output_bids_path: str, bids_sessions: list[BidsSession]):
+
+def copy_bids_sessions(
+    input_bids_path: str,
+    output_bids_path: str,
+    bids_sessions: list[BidsSession],
+    link_mode: LinkMode = 'copy',
+    workers: int = 8,
+):
     """
     Copy a BIDS dataset while filtering the acquisition files that do not belong to the specified
-    subject and session pairs.
+    subject and session pairs. The files are copied using the given link mode, which allows to
+    create read-only subsets of a dataset without duplicating its data, using a pool of `workers`
+    threads, while printing the progress in bytes.
     """
 
-    for file_1 in os.scandir(input_bids_path):
-        subject_match = re.search(r'sub-(.+)', file_1.name)
-        if subject_match:
-            subject_label = subject_match.group(1)
-            if not any(subject_label == bids_session.subject for bids_session in bids_sessions):
-                continue
+    dir_rel_paths, files = _list_bids_sessions_files(input_bids_path, bids_sessions)
 
-        file_1_output_path = os.path.join(output_bids_path, file_1.name)
+    # Create the directory structure before copying the files.
+    for dir_rel_path in dir_rel_paths:
+        os.mkdir(os.path.join(output_bids_path, dir_rel_path))
 
-        if not os.path.isdir(file_1.path):
-            shutil.copy(file_1.path, file_1_output_path)
-            continue
+    _copy_bids_files(input_bids_path, output_bids_path, files, link_mode, workers)
+    copy_bids_tsv_sessions(input_bids_path, output_bids_path, bids_sessions)
 
-        os.mkdir(file_1_output_path)
 
-        for file_2 in os.scandir(file_1.path):
-            session_match = re.search(r'ses-(.*)', file_2.name)
-            if session_match:
-                session_label = session_match.group(1)
-                if not any(session_label == bids_session.session for bids_session in bids_sessions):
-                    continue
+def sync_bids_sessions(
+    input_bids_path: str,
+    output_bids_path: str,
+    bids_sessions: list[BidsSession],
+    link_mode: LinkMode = 'copy',
+    workers: int = 8,
+    hash_content: bool = False,
+):
+    """
+    Incrementally update a filtered copy of a BIDS dataset created by `copy_bids_sessions` or by
+    a previous call of this function.
+
+    A manifest of the size and modification time of the input files is kept in the output
+    dataset. Only the files that are new or changed since the last synchronization are copied, and
+    the output files that are no longer selected are deleted. If `hash_content` is set, the SHA-256
+    hashes of the input files are also stored, and the files whose modification time changed but
+    whose content is the same are not copied again.
+    """
+
+    manifest_path = os.path.join(output_bids_path, BIDS_SYNC_MANIFEST_FILE_NAME)
+    old_manifest = _read_bids_sync_manifest(manifest_path)
+    new_manifest: dict[str, tuple[int, int, str]] = {}
+
+    dir_rel_paths, files = _list_bids_sessions_files(input_bids_path, bids_sessions)
 
-            file_2_output_path = os.path.join(output_bids_path, file_1.name, file_2.name)
+    changed_files: list[tuple[str, int, int]] = []
+    same_size_files: list[tuple[tuple[str, int, int], str]] = []
+    for file_rel_path, file_size, file_mtime in files:
+        output_file_path = os.path.join(output_bids_path, file_rel_path)
+        old_entry = old_manifest.pop(file_rel_path, None)
 
-            if not os.path.isdir(file_2.path):
-                shutil.copy(file_2.path, file_2_output_path)
+        if old_entry is not None and os.path.lexists(output_file_path):
+            old_size, old_mtime, old_sha256 = old_entry
+            if (old_size, old_mtime) == (file_size, file_mtime):
+                new_manifest[file_rel_path] = old_entry
                 continue
 
-            shutil.copytree(file_2.path, file_2_output_path)
+            if hash_content and old_size == file_size:
+                same_size_files.append(((file_rel_path, file_size, file_mtime), old_sha256))
+                continue
+
+        changed_files.append((file_rel_path, file_size, file_mtime))
+
+    # Compare the content of the files whose modification time changed but whose size did not.
+    if same_size_files:
+        def hash_input_file(same_size_file: tuple[tuple[str, int, int], str]) -> str:
+            return hash_file_sha256(os.path.join(input_bids_path, same_size_file[0][0]))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sha256s = map_bounded(executor, hash_input_file, same_size_files, workers * 4)
+            for (file, old_sha256), sha256 in zip(same_size_files, sha256s, strict=True):
+                if sha256 == old_sha256:
+                    new_manifest[file[0]] = (file[1], file[2], sha256)
+                else:
+                    changed_files.append(file)
+
+    # Delete the output files that are no longer selected, and then their empty directories.
+    for file_rel_path in old_manifest:
+        output_file_path = os.path.join(output_bids_path, file_rel_path)
+        if os.path.lexists(output_file_path):
+            os.remove(output_file_path)
+
+    selected_dir_rel_paths = set(dir_rel_paths)
+    for output_dir_path, _, _ in os.walk(output_bids_path, topdown=False):
+        dir_rel_path = os.path.relpath(output_dir_path, output_bids_path)
+        if dir_rel_path != '.' and dir_rel_path not in selected_dir_rel_paths and not os.listdir(output_dir_path):
+            os.rmdir(output_dir_path)
+
+    for dir_rel_path in dir_rel_paths:
+        os.makedirs(os.path.join(output_bids_path, dir_rel_path), exist_ok=True)
+
+    # Remove the outdated output files, which may be links to the input files.
+    for file_rel_path, _, _ in changed_files:
+        output_file_path = os.path.join(output_bids_path, file_rel_path)
+        if os.path.lexists(output_file_path):
+            os.remove(output_file_path)
+
+    sha256s = _copy_bids_files(input_bids_path, output_bids_path, changed_files, link_mode, workers, hash_content)
+
+    for (file_rel_path, file_size, file_mtime), sha256 in zip(changed_files, sha256s, strict=True):
+        new_manifest[file_rel_path] = (file_size, file_mtime, sha256)
+
+    copy_bids_tsv_sessions(input_bids_path, output_bids_path, bids_sessions)
+    _write_bids_sync_manifest(manifest_path, new_manifest)
+
+
+def copy_bids_tsv_sessions(input_bids_path: str, output_bids_path: str, bids_sessions: list[BidsSession]):
+    """
+    Copy the `participants.tsv`, `sessions.tsv` and `scans.tsv` files of a filtered copy of a BIDS
+    dataset while retaining only the rows that match the given BIDS subject and session pairs.
+    This function must be called after the acquisition files have been copied, as the rows of the
+    `scans.tsv` files are retained only if their acquisition file exists in the output dataset.
+    """
+
+    subject_sessions: dict[str, set[str]] = {}
+    for bids_session in bids_sessions:
+        subject_sessions.setdefault(bids_session.subject, set()).add(bids_session.session)
 
     copy_bids_participants_tsv_sessions(input_bids_path, output_bids_path, bids_sessions)
 
+    for subject_label, session_labels in subject_sessions.items():
+        subject_dir_name = f'sub-{subject_label}'
+        output_subject_dir_path = os.path.join(output_bids_path, subject_dir_name)
+        if not os.path.isdir(output_subject_dir_path):
+            continue
+
+        sessions_tsv_rel_path = os.path.join(subject_dir_name, f'{subject_dir_name}_sessions.tsv')
+        if os.path.exists(os.path.join(input_bids_path, sessions_tsv_rel_path)):
+            filter_bids_tsv(
+                os.path.join(input_bids_path,  sessions_tsv_rel_path),
+                os.path.join(output_bids_path, sessions_tsv_rel_path),
+                'session_id',
+                lambda session_id: session_id.removeprefix('ses-') in session_labels,
+            )
+
+        # The scans files can be found either in the subject directory or in the session directories.
+        scans_dirs = [(subject_dir_name, subject_dir_name)] + [
+            (os.path.join(subject_dir_name, f'ses-{session_label}'), f'{subject_dir_name}_ses-{session_label}')
+            for session_label in session_labels
+        ]
+
+        for scans_dir_rel_path, scans_tsv_prefix in scans_dirs:
+            scans_tsv_rel_path = os.path.join(scans_dir_rel_path, f'{scans_tsv_prefix}_scans.tsv')
+            if not os.path.exists(os.path.join(input_bids_path, scans_tsv_rel_path)):
+                continue
+
+            output_scans_dir_path = os.path.join(output_bids_path, scans_dir_rel_path)
+            filter_bids_tsv(
+                os.path.join(input_bids_path,  scans_tsv_rel_path),
+                os.path.join(output_bids_path, scans_tsv_rel_path),
+                'filename',
+                lambda file_name: os.path.lexists(os.path.join(output_scans_dir_path, file_name)),
+            )
+
 
 def copy_bids_participants_tsv_sessions(input_bids_path: str, output_bids_path: str, bids_sessions: list[BidsSession]):
     """
     Copy a BIDS `participants.tsv` file while retaining only the subjects that are specified in the
-    given BIDS subject and session pairs.
+    given BIDS subject and session pairs. The output file is only rewritten if its content
+    changes.
     """
 
-    bids_subject_labels = list(map(lambda bids_session: bids_session.subject, bids_sessions))
+    bids_subject_labels = {bids_session.subject for bids_session in bids_sessions}
 
     input_participants_path  = os.path.join(input_bids_path,  'participants.tsv')
     output_participants_path = os.path.join(output_bids_path, 'participants.tsv')
@@ -99,22 +313,45 @@ def copy_bids_participants_tsv_sessions(input_bids_path: str, output_bids_path:
     if not os.path.exists(input_participants_path):
         return
 
-    with open(input_participants_path) as input_participants_file:
-        reader = csv.DictReader(input_participants_file.readlines(), delimiter='\t')
+    filter_bids_tsv(
+        input_participants_path,
+        output_participants_path,
+        'participant_id',
+        lambda participant_id: participant_id.removeprefix('sub-') in bids_subject_labels,
+    )
 
-    if reader.fieldnames is None:
-        return
 
-    if 'participant_id' not in reader.fieldnames:
-        return
+def filter_bids_tsv(
+    input_tsv_path: str,
+    output_tsv_path: str,
+    column_name: str,
+    predicate: Callable[[str], bool],
+):
+    """
+    Copy a BIDS TSV file row by row, retaining only the rows whose value in the given column
+    satisfies the predicate, in constant memory. The file is copied unchanged if it does not have
+    that column. The output file is only rewritten if its content changes.
+    """
+
+    output_dir_path, output_tsv_name = os.path.split(output_tsv_path)
+    tmp_tsv_path = os.path.join(output_dir_path, f'.{output_tsv_name}.tmp')
 
-    with open(output_participants_path, 'w') as output_participants_file:
-        writer = csv.DictWriter(output_participants_file, fieldnames=reader.fieldnames, delimiter='\t')
-        writer.writeheader()
-        for row in reader:
-            bids_subject_label = re.sub(r'^sub-', '', row['participant_id'])
-            if bids_subject_label in bids_subject_labels:
-                writer.writerow(row)
+    with open(input_tsv_path, newline='') as input_tsv_file, open(tmp_tsv_path, 'w', newline='') as tmp_tsv_file:
+        header = input_tsv_file.readline()
+        tmp_tsv_file.write(header)
+
+        column_names = header.rstrip('\r\n').split('\t')
+        column_index = column_names.index(column_name) if column_name in column_names else None
+
+        for line in input_tsv_file:
+            if column_index is not None:
+                values = line.rstrip('\r\n').split('\t')
+                if column_index < len(values) and not predicate(values[column_index]):
+                    continue
+
+            tmp_tsv_file.write(line)
+
+    _replace_file_if_changed(tmp_tsv_path, output_tsv_path)
 
 
 def has_bids_session(bids_path: str, bids_session: BidsSession) -> bool:
@@ -124,3 +361,411 @@ def has_bids_session(bids_path: str, bids_session: BidsSession) -> bool:
 
     bids_session_dir_path = os.path.join(bids_path, f'sub-{bids_session.subject}', f'ses-{bids_session.session}')
     return os.path.exists(bids_session_dir_path)
+
+
+BIDS_FILE_INDEX_ENTITIES = ('sub', 'ses', 'task', 'acq', 'ce', 'rec', 'dir', 'run', 'echo', 'part')
+"""
+BIDS entities indexed by the BIDS file index, in addition to the datatype, suffix and extension.
+"""
+
+
+@dataclass
+class BidsFileIndex:
+    """
+    An index of the files of the subject directories of a BIDS dataset by BIDS entities.
+
+    The index is stored column by column, the i-th element of each column describing the i-th
+    file. The directory, entity, datatype, suffix, and extension columns are arrays of identifiers
+    of strings of the string table, with the identifier 0 standing for an absent value.
+    """
+
+    path: str
+    """
+    Path of the BIDS dataset.
+    """
+
+    strings: list[str]
+    """
+    String table of the index.
+    """
+
+    string_ids: dict[str, int]
+    """
+    Identifier of each string of the string table.
+    """
+
+    file_names: list[str]
+    """
+    Name of each file.
+    """
+
+    columns: dict[str, 'array[int]']
+    """
+    String identifier columns, keyed by `directory`, `datatype`, `suffix`, `extension` and the indexed
+    BIDS entities.
+    """
+
+    dir_mtimes: dict[str, int]
+    """
+    Modification time of each indexed directory, keyed by path relative to the dataset, at the
+    time of its last scan.
+    """
+
+
+def build_bids_file_index(bids_path: str) -> BidsFileIndex:
+    """
+    Parse the name of every file in the subject directories of a BIDS dataset into a BIDS file
+    index.
+    """
+
+    bids_file_index = BidsFileIndex(bids_path, [''], {'': 0}, [], _new_bids_file_index_columns(), {})
+    update_bids_file_index(bids_file_index)
+    return bids_file_index
+
+
+def update_bids_file_index(bids_file_index: BidsFileIndex):
+    """
+    Update a BIDS file index with the current state of its dataset. Only the directories whose
+    modification time changed since the last update are listed again.
+    """
+
+    dir_rel_paths = ['', *(bids_file_index.dir_mtimes.keys() - {''})]
+    changed_dir_rel_paths: set[str] = set()
+    new_rows: list[tuple[str, str]] = []
+
+    while dir_rel_paths:
+        dir_rel_path = dir_rel_paths.pop()
+        dir_path = os.path.join(bids_file_index.path, dir_rel_path)
+
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            _remove_bids_file_index_dirs(bids_file_index, dir_rel_path)
+            changed_dir_rel_paths.add(dir_rel_path)
+            continue
+
+        if bids_file_index.dir_mtimes.get(dir_rel_path) == dir_mtime:
+            continue
+
+        bids_file_index.dir_mtimes[dir_rel_path] = dir_mtime
+        changed_dir_rel_paths.add(dir_rel_path)
+
+        with os.scandir(dir_path) as iterator:
+            for entry in iterator:
+                # Only the subject directories are indexed at the root of the dataset.
+                if dir_rel_path == '' and not _SUBJECT_DIR_REGEX.match(entry.name):
+                    continue
+
+                entry_rel_path = os.path.join(dir_rel_path, entry.name)
+                if entry.is_dir():
+                    if entry_rel_path not in bids_file_index.dir_mtimes:
+                        dir_rel_paths.append(entry_rel_path)
+                else:
+                    new_rows.append((dir_rel_path, entry.name))
+
+    if not changed_dir_rel_paths:
+        return
+
+    # Remove the rows of the directories that were listed again, then append their new rows.
+    changed_dir_ids = {bids_file_index.string_ids.get(dir_rel_path) for dir_rel_path in changed_dir_rel_paths}
+    kept_rows = [i for i, dir_id in enumerate(bids_file_index.columns['directory']) if dir_id not in changed_dir_ids]
+    if len(kept_rows) != len(bids_file_index.file_names):
+        bids_file_index.file_names = [bids_file_index.file_names[i] for i in kept_rows]
+        for name, column in bids_file_index.columns.items():
+            bids_file_index.columns[name] = array('I', (column[i] for i in kept_rows))
+
+    for dir_rel_path, file_name in new_rows:
+        _add_bids_file_index_row(bids_file_index, dir_rel_path, file_name)
+
+
+def find_bids_files(
+    bids_file_index: BidsFileIndex,
+    bids_sessions: Iterable[BidsSession] | None = None,
+    datatype: str | None = None,
+    suffix: str | None = None,
+    extension: str | None = None,
+    **entities: str,
+) -> list[str]:
+    """
+    Find the files of a BIDS file index that match the given subject and session pairs, datatype,
+    suffix, extension and BIDS entities (such as `task` or `run`), and return their paths relative
+    to the dataset.
+    """
+
+    filters = {'datatype': datatype, 'suffix': suffix, 'extension': extension, **entities}
+    column_filters: list[tuple[array[int], int]] = []
+    for name, value in filters.items():
+        if value is None:
+            continue
+
+        if name not in bids_file_index.columns:
+            raise ValueError(f"BIDS entity '{name}' is not indexed.")
+
+        string_id = bids_file_index.string_ids.get(value)
+        if string_id is None:
+            return []
+
+        column_filters.append((bids_file_index.columns[name], string_id))
+
+    session_ids: set[tuple[int, int]] | None = None
+    if bids_sessions is not None:
+        string_ids = bids_file_index.string_ids
+        session_ids = {
+            (string_ids.get(bids_session.subject, -1), string_ids.get(bids_session.session, -1))
+            for bids_session in bids_sessions
+        }
+
+    subjects = bids_file_index.columns['sub']
+    sessions = bids_file_index.columns['ses']
+    directories = bids_file_index.columns['directory']
+
+    file_rel_paths: list[str] = []
+    for i, file_name in enumerate(bids_file_index.file_names):
+        if session_ids is not None and (subjects[i], sessions[i]) not in session_ids:
+            continue
+
+        if any(column[i] != string_id for column, string_id in column_filters):
+            continue
+
+        file_rel_paths.append(os.path.join(bids_file_index.strings[directories[i]], file_name))
+
+    return file_rel_paths
+
+
+def save_bids_file_index(bids_file_index: BidsFileIndex, index_path: str):
+    """
+    Write a BIDS file index to a JSON file.
+    """
+
+    with open(index_path, 'w') as index_file:
+        json.dump({
+            'path':       bids_file_index.path,
+            'strings':    bids_file_index.strings,
+            'file_names': bids_file_index.file_names,
+            'columns':    {name: column.tolist() for name, column in bids_file_index.columns.items()},
+            'dir_mtimes': bids_file_index.dir_mtimes,
+        }, index_file)
+
+
+def load_bids_file_index(index_path: str) -> BidsFileIndex:
+    """
+    Read a BIDS file index from a JSON file written by `save_bids_file_index`.
+    """
+
+    with open(index_path) as index_file:
+        data = json.load(index_file)
+
+    strings: list[str] = data['strings']
+    return BidsFileIndex(
+        path       = data['path'],
+        strings    = strings,
+        string_ids = {string: i for i, string in enumerate(strings)},
+        file_names = data['file_names'],
+        columns    = {name: array('I', column) for name, column in data['columns'].items()},
+        dir_mtimes = data['dir_mtimes'],
+    )
+
+
+def _list_bids_sessions_files(
+    bids_path: str,
+    bids_sessions: list[BidsSession],
+) -> tuple[list[str], list[tuple[str, int, int]]]:
+    """
+    List the directories and the files of a BIDS dataset that belong to the specified subject and
+    session pairs, or that do not belong to any subject. Return the relative paths of these
+    directories, and the relative path, size, and modification time of these files. The
+    `participants.tsv` file is not listed as it is filtered separately.
+    """
+
+    subject_sessions: dict[str, set[str]] = {}
+    for bids_session in bids_sessions:
+        subject_sessions.setdefault(bids_session.subject, set()).add(bids_session.session)
+
+    dir_rel_paths: list[str] = []
+    files: list[tuple[str, int, int]] = []
+
+    for file_1 in os.scandir(bids_path):
+        session_labels = None
+        subject_match = _SUBJECT_DIR_REGEX.match(file_1.name)
+        if subject_match:
+            session_labels = subject_sessions.get(subject_match.group(1))
+            if session_labels is None:
+                continue
+
+        if not file_1.is_dir():
+            if file_1.name != 'participants.tsv':
+                files.append((file_1.name, file_1.stat().st_size, file_1.stat().st_mtime_ns))
+
+            continue
+
+        dir_rel_paths.append(file_1.name)
+
+        for file_2 in os.scandir(file_1.path):
+            session_match = _SESSION_DIR_REGEX.match(file_2.name)
+            if session_match and session_labels is not None and session_match.group(1) not in session_labels:
+                continue
+
+            file_2_rel_path = os.path.join(file_1.name, file_2.name)
+
+            if not file_2.is_dir():
+                files.append((file_2_rel_path, file_2.stat().st_size, file_2.stat().st_mtime_ns))
+                continue
+
+            _list_dir_files_rec(bids_path, file_2_rel_path, dir_rel_paths, files)
+
+    return dir_rel_paths, files
+
+
+def _copy_bids_files(
+    input_bids_path: str,
+    output_bids_path: str,
+    files: list[tuple[str, int, int]],
+    link_mode: LinkMode,
+    workers: int,
+    hash_content: bool = False,
+) -> list[str]:
+    """
+    Copy files of a BIDS dataset to another BIDS dataset using a pool of threads, while printing
+    the progress in bytes. If `hash_content` is set, the SHA-256 hash of each input file is also
+    computed by the thread that copies it, and the hashes are returned in the order of the files,
+    or empty hashes otherwise.
+    """
+
+    progress = get_file_size_progress_printer(sum(file_size for _, file_size, _ in files))
+
+    def copy_file(file: tuple[str, int, int]) -> str:
+        file_rel_path, file_size, _ = file
+        input_file_path  = os.path.join(input_bids_path,  file_rel_path)
+        output_file_path = os.path.join(output_bids_path, file_rel_path)
+        copy_file_link(input_file_path, output_file_path, link_mode)
+        sha256 = hash_file_sha256(input_file_path) if hash_content else ''
+        progress(file_size)
+        return sha256
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(map_bounded(executor, copy_file, files, workers * 4))
+
+
+def _read_bids_sync_manifest(manifest_path: str) -> dict[str, tuple[int, int, str]]:
+    """
+    Read the manifest of a synchronized BIDS dataset, and return the size, modification time, and
+    optional SHA-256 hash of each input file, keyed by relative path.
+    """
+
+    manifest: dict[str, tuple[int, int, str]] = {}
+
+    if not os.path.exists(manifest_path):
+        return manifest
+
+    with open(manifest_path, newline='') as manifest_file:
+        for row in csv.DictReader(manifest_file, delimiter='\t'):
+            manifest[row['path']] = (int(row['size']), int(row['mtime_ns']), row['sha256'])
+
+    return manifest
+
+
+def _write_bids_sync_manifest(manifest_path: str, manifest: dict[str, tuple[int, int, str]]):
+    """
+    Write the manifest of a synchronized BIDS dataset, replacing the previous manifest once the
+    new one is complete.
+    """
+
+    tmp_manifest_path = f'{manifest_path}.tmp'
+    with open(tmp_manifest_path, 'w', newline='') as manifest_file:
+        writer = csv.writer(manifest_file, delimiter='\t')
+        writer.writerow(['path', 'size', 'mtime_ns', 'sha256'])
+        for file_rel_path, (file_size, file_mtime, sha256) in sorted(manifest.items()):
+            writer.writerow([file_rel_path, file_size, file_mtime, sha256])
+
+    os.replace(tmp_manifest_path, manifest_path)
+
+
+def _replace_file_if_changed(tmp_file_path: str, file_path: str):
+    """
+    Move a temporary file to a path if the content of that file differs from the content of the
+    file at that path, or delete the temporary file otherwise.
+    """
+
+    if os.path.exists(file_path) and filecmp.cmp(tmp_file_path, file_path, shallow=False):
+        os.remove(tmp_file_path)
+    else:
+        os.replace(tmp_file_path, file_path)
+
+
+def _list_dir_files_rec(
+    root_dir_path: str,
+    dir_rel_path: str,
+    dir_rel_paths: list[str],
+    files: list[tuple[str, int, int]],
+):
+    """
+    List the subdirectories and the files of a directory recursively, adding their paths relative
+    to the root directory to the given lists, along with the size and modification time of each
+    file.
+    """
+
+    dir_rel_paths.append(dir_rel_path)
+
+    with os.scandir(os.path.join(root_dir_path, dir_rel_path)) as iterator:
+        for entry in iterator:
+            entry_rel_path = os.path.join(dir_rel_path, entry.name)
+            if entry.is_dir():
+                _list_dir_files_rec(root_dir_path, entry_rel_path, dir_rel_paths, files)
+            else:
+                entry_stat = entry.stat()
+                files.append((entry_rel_path, entry_stat.st_size, entry_stat.st_mtime_ns))
+
+
+def _new_bids_file_index_columns() -> dict[str, 'array[int]']:
+    """
+    Create the empty columns of a BIDS file index.
+    """
+
+    names = ('directory', 'datatype', 'suffix', 'extension', *BIDS_FILE_INDEX_ENTITIES)
+    return {name: array('I') for name in names}
+
+
+def _add_bids_file_index_row(bids_file_index: BidsFileIndex, dir_rel_path: str, file_name: str):
+    """
+    Parse the name of a file and add it to a BIDS file index.
+    """
+
+    stem, dot, extension = file_name.partition('.')
+    parts = stem.split('_')
+
+    values = dict.fromkeys(bids_file_index.columns, '')
+    values['directory'] = dir_rel_path
+    values['extension'] = dot + extension
+
+    if '-' not in parts[-1]:
+        values['suffix'] = parts.pop()
+
+    for part in parts:
+        key, _, value = part.partition('-')
+        if key in BIDS_FILE_INDEX_ENTITIES:
+            values[key] = value
+
+    dir_name = os.path.basename(dir_rel_path)
+    if not _SUBJECT_DIR_REGEX.match(dir_name) and not _SESSION_DIR_REGEX.match(dir_name):
+        values['datatype'] = dir_name
+
+    bids_file_index.file_names.append(file_name)
+    for name, value in values.items():
+        string_id = bids_file_index.string_ids.get(value)
+        if string_id is None:
+            string_id = len(bids_file_index.strings)
+            bids_file_index.strings.append(value)
+            bids_file_index.string_ids[value] = string_id
+
+        bids_file_index.columns[name].append(string_id)
+
+
+def _remove_bids_file_index_dirs(bids_file_index: BidsFileIndex, dir_rel_path: str):
+    """
+    Remove a deleted directory and its subdirectories from the directories of a BIDS file index.
+    """
+
+    prefix = os.path.join(dir_rel_path, '')
+    for indexed_dir_rel_path in list(bids_file_index.dir_mtimes):
+        if indexed_dir_rel_path == dir_rel_path or indexed_dir_rel_path.startswith(prefix):
+            del bids_file_index.dir_mtimes[indexed_dir_rel_path]
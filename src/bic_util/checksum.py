@@ -0,0 +1,252 @@
+import argparse
+import csv
+import glob
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from bic_util.fs import DirSnapshotFile, scan_dir
+from bic_util.print import get_file_size_progress_printer, print_error, print_error_exit
+from bic_util.util import map_bounded
+
+
+@dataclass
+class ChecksumVerification:
+    """
+    The result of the verification of a directory against a checksum manifest.
+    """
+
+    missing_files: list[str]
+    """
+    Files listed in the manifest that are not found in the directory.
+    """
+
+    mismatched_files: list[str]
+    """
+    Files whose checksum differs from the checksum listed in the manifest.
+    """
+
+    extra_files: list[str]
+    """
+    Files found in the directory that are not listed in the manifest.
+    """
+
+    @property
+    def ok(self) -> bool:
+        """
+        Whether the directory matches the manifest.
+        """
+
+        return not self.missing_files and not self.mismatched_files and not self.extra_files
+
+
+def compute_dir_checksums(
+    dir_path: str,
+    workers: int = 8,
+    cache_path: str | None = None,
+    exclude_paths: list[str] | None = None,
+) -> dict[str, str]:
+    """
+    Compute the SHA-256 checksum of each file of a directory recursively using a pool of `workers`
+    threads, and return these checksums keyed by relative path. The files of `exclude_paths` that
+    are inside the directory are not checksummed.
+
+    If a cache path is provided, the checksums of the files whose size and modification time did
+    not change since they were cached are read from that cache instead of being computed, and the
+    cache is then updated. The cache itself is not checksummed if it is inside the directory.
+    """
+
+    exclude_paths = list(exclude_paths) if exclude_paths is not None else []
+    if cache_path is not None:
+        exclude_paths += [cache_path, f'{cache_path}.tmp']
+
+    snapshot = scan_dir(dir_path, exclude=_get_exclude_patterns(dir_path, exclude_paths))
+    cache = _read_checksum_cache(cache_path) if cache_path is not None else {}
+    checksums: dict[str, str] = {}
+
+    files_to_hash: list[DirSnapshotFile] = []
+    for file in snapshot.files:
+        cache_entry = cache.get(file.path)
+        if cache_entry is not None and cache_entry[:2] == (file.size, file.mtime_ns):
+            checksums[file.path] = cache_entry[2]
+        else:
+            files_to_hash.append(file)
+
+    progress = get_file_size_progress_printer(sum(file.size for file in files_to_hash), len(files_to_hash))
+
+    def hash_file(file: DirSnapshotFile) -> str:
+        checksum = hash_file_sha256(os.path.join(dir_path, file.path))
+        progress(file.size)
+        return checksum
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        file_checksums = map_bounded(executor, hash_file, files_to_hash, workers * 4)
+        for file, checksum in zip(files_to_hash, file_checksums, strict=True):
+            checksums[file.path] = checksum
+
+    if cache_path is not None:
+        _write_checksum_cache(cache_path, snapshot.files, checksums)
+
+    return checksums
+
+
+def write_checksum_manifest(dir_path: str, manifest_path: str, workers: int = 8, cache_path: str | None = None):
+    """
+    Compute the SHA-256 checksums of the files of a directory and write them in a manifest file,
+    using the format of `sha256sum` with paths relative to that directory. The manifest file
+    itself is not listed if it is inside the directory.
+    """
+
+    checksums = compute_dir_checksums(dir_path, workers, cache_path, [manifest_path])
+
+    with open(manifest_path, 'w') as manifest_file:
+        for file_rel_path, checksum in sorted(checksums.items()):
+            manifest_file.write(f'{checksum}  {file_rel_path}\n')
+
+
+def verify_checksum_manifest(
+    dir_path: str,
+    manifest_path: str,
+    workers: int = 8,
+    cache_path: str | None = None,
+) -> ChecksumVerification:
+    """
+    Verify the files of a directory against a checksum manifest written by
+    `write_checksum_manifest` or by `sha256sum`. The manifest file itself is not verified if it is
+    inside the directory.
+    """
+
+    expected_checksums = read_checksum_manifest(manifest_path)
+    checksums = compute_dir_checksums(dir_path, workers, cache_path, [manifest_path])
+
+    return ChecksumVerification(
+        missing_files    = sorted(expected_checksums.keys() - checksums.keys()),
+        mismatched_files = sorted(
+            file_rel_path for file_rel_path, checksum in checksums.items()
+            if file_rel_path in expected_checksums and expected_checksums[file_rel_path] != checksum
+        ),
+        extra_files      = sorted(checksums.keys() - expected_checksums.keys()),
+    )
+
+
+def read_checksum_manifest(manifest_path: str) -> dict[str, str]:
+    """
+    Read a checksum manifest in the format of `sha256sum`, and return the checksums keyed by
+    relative path.
+    """
+
+    checksums: dict[str, str] = {}
+
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+
+            # The separator is two spaces, or a space and an asterisk in binary mode.
+            checksum, file_rel_path = line[:64], line[66:]
+            checksums[os.path.normpath(file_rel_path)] = checksum.lower()
+
+    return checksums
+
+
+def hash_file_sha256(file_path: str) -> str:
+    """
+    Get the SHA-256 checksum of a file. Small files are read in a single read, large files are
+    memory-mapped, and the hash is computed without holding the GIL in both cases.
+    """
+
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < _MMAP_MIN_SIZE:
+            return hashlib.sha256(file.read()).hexdigest()
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+def main():
+    """
+    Entry point of the `bic-checksum` command, which writes or verifies checksum manifests.
+    """
+
+    parser = argparse.ArgumentParser(description="Write or verify the SHA-256 checksum manifest of a directory.")
+    parser.add_argument('command', choices=['write', 'verify'], help="Write a new manifest or verify a manifest.")
+    parser.add_argument('dir_path', help="Directory whose files are checksummed.")
+    parser.add_argument('manifest_path', help="Path of the checksum manifest.")
+    parser.add_argument('--workers', type=int, default=8, help="Number of hashing threads.")
+    parser.add_argument('--cache', help="Path of a cache of the checksums keyed by file size and modification time.")
+    args = parser.parse_args()
+
+    if args.command == 'write':
+        write_checksum_manifest(args.dir_path, args.manifest_path, args.workers, args.cache)
+        return
+
+    verification = verify_checksum_manifest(args.dir_path, args.manifest_path, args.workers, args.cache)
+    for file_rel_path in verification.missing_files:
+        print_error(f"Missing file '{file_rel_path}'.")
+
+    for file_rel_path in verification.mismatched_files:
+        print_error(f"Checksum mismatch for file '{file_rel_path}'.")
+
+    for file_rel_path in verification.extra_files:
+        print_error(f"Unexpected file '{file_rel_path}'.")
+
+    if not verification.ok:
+        print_error_exit(f"Directory '{args.dir_path}' does not match manifest '{args.manifest_path}'.", 1)
+
+    print("All checksums match.")
+
+
+_MMAP_MIN_SIZE = 1024 * 1024
+
+
+def _read_checksum_cache(cache_path: str) -> dict[str, tuple[int, int, str]]:
+    """
+    Read a checksum cache, and return the size, modification time, and checksum of each file keyed
+    by relative path.
+    """
+
+    cache: dict[str, tuple[int, int, str]] = {}
+
+    if not os.path.exists(cache_path):
+        return cache
+
+    with open(cache_path, newline='') as cache_file:
+        for row in csv.reader(cache_file, delimiter='\t'):
+            file_rel_path, size, mtime_ns, checksum = row
+            cache[file_rel_path] = (int(size), int(mtime_ns), checksum)
+
+    return cache
+
+
+def _get_exclude_patterns(dir_path: str, file_paths: list[str]) -> list[str]:
+    """
+    Utility function for `compute_dir_checksums` that gets the `scan_dir` patterns that exclude the
+    files of a list that are inside a directory.
+    """
+
+    real_dir_path = os.path.realpath(dir_path)
+    patterns: list[str] = []
+    for file_path in file_paths:
+        file_rel_path = os.path.relpath(os.path.realpath(file_path), real_dir_path)
+        if file_rel_path != os.pardir and not file_rel_path.startswith(os.pardir + os.sep):
+            patterns.append(glob.escape(file_rel_path))
+
+    return patterns
+
+
+def _write_checksum_cache(cache_path: str, files: list[DirSnapshotFile], checksums: dict[str, str]):
+    """
+    Write a checksum cache, replacing the previous cache once the new one is complete.
+    """
+
+    tmp_cache_path = f'{cache_path}.tmp'
+    with open(tmp_cache_path, 'w', newline='') as cache_file:
+        writer = csv.writer(cache_file, delimiter='\t')
+        for file in files:
+            writer.writerow([file.path, file.size, file.mtime_ns, checksums[file.path]])
+
+    os.replace(tmp_cache_path, cache_path)
@@ -1,11 +1,35 @@
+import io
 import os
 import shutil
+import struct
+import tarfile
+from array import array
+from collections import Counter
+from collections.abc import Callable, Generator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import pairwise
+from typing import BinaryIO
 
 import pydicom
-import pydicom.misc
+from pydicom.tag import TagListType
 
-from bic_util.fs import count_all_dir_files
-from bic_util.print import get_progress_printer
+from bic_util.fs import copy_file_bytes, scan_dir
+from bic_util.print import get_progress_printer, print_error, print_error_exit
+
+
+def read_dicom_tags(file_path: str, tags: TagListType) -> pydicom.Dataset | None:
+    """
+    Read only the given tags of a DICOM file, without reading its pixel data, or return `None` if
+    the file is not a DICOM file.
+    """
+
+    with open(file_path, 'rb') as file:
+        if not _read_dicom_preamble(file):
+            return None
+
+        file.seek(0)
+        return pydicom.dcmread(file, stop_before_pixels=True, specific_tags=tags)  # type: ignore
 
 
 def get_dicom_study_patient_name(dicom_study_path: str) -> str | None:
@@ -17,41 +41,607 @@ def get_dicom_study_patient_name(dicom_study_path: str) -> str | None:
         for file_name in file_names:
             file_path = os.path.join(dir_path, file_name)
 
-            if pydicom.misc.is_dicom(file_path):
-                ds = pydicom.dcmread(file_path)  # type: ignore
+            ds = read_dicom_tags(file_path, ['PatientName'])
+            if ds is not None:
                 return str(ds.PatientName)
 
     return None
 
 
+@dataclass
+class DicomStudySummary:
+    """
+    Aggregated information about the series of a DICOM study, stored column by column, the i-th
+    element of each column describing the i-th series.
+    """
+
+    series_instance_uids: list[str]
+    """
+    Series instance UID of each series, or an empty string for the DICOM files that do not have
+    one.
+    """
+
+    series_descriptions: list[str | None]
+    modalities: list[str | None]
+
+    file_counts: 'array[int]'
+    """
+    Number of DICOM files of each series.
+    """
+
+    total_sizes: 'array[int]'
+    """
+    Total size of the DICOM files of each series in bytes.
+    """
+
+    duplicate_instance_numbers: list[tuple[int, ...]]
+    """
+    Instance numbers found in more than one DICOM file of each series.
+    """
+
+    missing_instance_numbers: list[tuple[range, ...]]
+    """
+    Ranges of instance numbers missing between the lowest and the highest instance numbers of each
+    series.
+    """
+
+
+def summarize_dicom_study(dicom_study_path: str, workers: int = 8) -> DicomStudySummary:
+    """
+    Read the headers of the DICOM files of a DICOM study using a pool of `workers` threads, without
+    reading their pixel data, and return the aggregated information of each series of that study.
+    """
+
+    snapshot = scan_dir(dicom_study_path)
+    file_paths = [os.path.join(dicom_study_path, file.path) for file in snapshot.files]
+
+    summary = DicomStudySummary([], [], [], array('q'), array('q'), [], [])
+    series_indexes: dict[str, int] = {}
+    series_instance_numbers: list[list[int]] = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_summary in executor.map(_summarize_dicom_file, file_paths):
+            if file_summary is None:
+                continue
+
+            series_instance_uid, series_description, modality, instance_number, size = file_summary
+
+            series_index = series_indexes.get(series_instance_uid)
+            if series_index is None:
+                series_index = len(summary.series_instance_uids)
+                series_indexes[series_instance_uid] = series_index
+                summary.series_instance_uids.append(series_instance_uid)
+                summary.series_descriptions.append(series_description)
+                summary.modalities.append(modality)
+                summary.file_counts.append(0)
+                summary.total_sizes.append(0)
+                series_instance_numbers.append([])
+
+            summary.file_counts[series_index] += 1
+            summary.total_sizes[series_index] += size
+            if instance_number is not None:
+                series_instance_numbers[series_index].append(instance_number)
+
+    for instance_numbers in series_instance_numbers:
+        counts = Counter(instance_numbers)
+        duplicates = sorted(number for number, count in counts.items() if count > 1)
+        summary.duplicate_instance_numbers.append(tuple(duplicates))
+        numbers = sorted(counts)
+        missing = [range(low + 1, high) for low, high in pairwise(numbers) if high - low > 1]
+        summary.missing_instance_numbers.append(tuple(missing))
+
+    return summary
+
+
+DICOM_COPY_JOURNAL_FILE_NAME = '.bic_util_copy_journal'
+"""
+Name of the journal file of the files already copied by `copy_dicom_dir_patch_patient_name`,
+which is written in the destination directory and deleted once the copy is complete.
+"""
+
+
 def copy_dicom_dir_patch_patient_name(
     src_dicom_dir_path: str,
     dst_dicom_dir_path: str,
     patient_name: str,
+    workers: int | None = None,
+    resume: bool = False,
 ) -> None:
     """
     Copy a DICOM directory while renaming its DICOM patient name attribute.
+
+    The patient name is patched by rewriting only the bytes of that attribute when possible, the
+    rest of each DICOM file being copied unchanged without being decoded.
+
+    If `workers` is provided, the files are patched and copied in parallel using a pool of that
+    many processes, and the errors are reported for each file before exiting the program.
+
+    Each file is written to a temporary file that is renamed once complete, and recorded in a
+    journal in the destination directory. If `resume` is set, an interrupted copy is continued,
+    skipping the files recorded in the journal.
     """
 
-    progress = get_progress_printer(count_all_dir_files(src_dicom_dir_path))
+    journal_path = os.path.join(dst_dicom_dir_path, DICOM_COPY_JOURNAL_FILE_NAME)
+    copied_files = _read_dicom_copy_journal(journal_path) if resume else {}
+
+    snapshot = scan_dir(src_dicom_dir_path)
+    file_rel_paths = [file.path for file in snapshot.files]
 
-    for src_dir_path, _, src_file_names in os.walk(src_dicom_dir_path):
-        dir_rel_path = os.path.relpath(src_dir_path, src_dicom_dir_path)
-        dst_dir_path = os.path.join(dst_dicom_dir_path, dir_rel_path)
+    # Copy the directory structure before copying any file.
+    for dir_rel_path in snapshot.dir_paths:
+        os.makedirs(os.path.join(dst_dicom_dir_path, dir_rel_path), exist_ok=resume)
 
-        # Copy directory structure
-        os.makedirs(dst_dir_path)
+    progress = get_progress_printer(len(file_rel_paths))
 
-        # Patch and copy files and DICOMs
-        for src_file_name in src_file_names:
+    # Skip the files that were completely copied by a previous run.
+    remaining_file_rel_paths: list[str] = []
+    for file_rel_path in file_rel_paths:
+        copied_file_size = copied_files.get(file_rel_path)
+        dst_file_path = os.path.join(dst_dicom_dir_path, file_rel_path)
+        if copied_file_size is not None and _get_file_size_or_none(dst_file_path) == copied_file_size:
             next(progress)
-            src_file_path = os.path.join(src_dir_path, src_file_name)
-            dst_file_path = os.path.join(dst_dir_path, src_file_name)
+        else:
+            remaining_file_rel_paths.append(file_rel_path)
 
-            if not pydicom.misc.is_dicom(src_file_path):
-                shutil.copyfile(src_file_path, dst_file_path)
-                continue
+    with open(journal_path, 'a') as journal_file:
+        def copy_file(file_rel_path: str):
+            return _copy_dicom_file_patch_patient_name(
+                os.path.join(src_dicom_dir_path, file_rel_path),
+                os.path.join(dst_dicom_dir_path, file_rel_path),
+                patient_name,
+            )
+
+        def journal_file_copied(file_rel_path: str, file_size: int):
+            journal_file.write(f'{file_size}\t{file_rel_path}\n')
+            journal_file.flush()
+
+        if workers is None:
+            for file_rel_path in remaining_file_rel_paths:
+                next(progress)
+                journal_file_copied(file_rel_path, copy_file(file_rel_path))
+        else:
+            _copy_dicom_files_patch_patient_name_parallel(
+                src_dicom_dir_path,
+                dst_dicom_dir_path,
+                remaining_file_rel_paths,
+                patient_name,
+                workers,
+                progress,
+                journal_file_copied,
+            )
+
+    os.remove(journal_path)
+
+
+def tar_dicom_dir_patch_patient_name(
+    src_dicom_dir_path: str,
+    tar_output: str | BinaryIO,
+    patient_name: str,
+    dir_alias: str | None = None,
+) -> None:
+    """
+    Archive a DICOM directory into a tar stream while renaming its DICOM patient name attribute,
+    without writing the patched files to disk. The output can be either the path of a tar file or
+    a writable binary stream such as a pipe. Non-DICOM files are archived unchanged.
+    """
+
+    arc_root_name = dir_alias if dir_alias is not None else os.path.basename(os.path.normpath(src_dicom_dir_path))
+    snapshot = scan_dir(src_dicom_dir_path)
+    progress = get_progress_printer(len(snapshot.files))
+
+    if isinstance(tar_output, str):
+        tar = tarfile.open(tar_output, 'w|')
+    else:
+        tar = tarfile.open(fileobj=tar_output, mode='w|')
+
+    with tar:
+        for dir_rel_path in snapshot.dir_paths:
+            src_dir_path = os.path.join(src_dicom_dir_path, dir_rel_path)
+            arc_dir_path = os.path.normpath(os.path.join(arc_root_name, dir_rel_path))
+            tar.add(src_dir_path, arcname=arc_dir_path, recursive=False)
+
+        for file in snapshot.files:
+            next(progress)
+            src_file_path = os.path.join(src_dicom_dir_path, file.path)
+            arc_file_path = os.path.join(arc_root_name, file.path)
+            _add_dicom_file_patch_patient_name(tar, src_file_path, arc_file_path, patient_name)
+
+        for dir_link in snapshot.dir_links:
+            src_link_path = os.path.join(src_dicom_dir_path, dir_link.path)
+            arc_link_path = os.path.join(arc_root_name, dir_link.path)
+            tar.add(src_link_path, arcname=arc_link_path)
+
+
+def _copy_dicom_files_patch_patient_name_parallel(
+    src_dicom_dir_path: str,
+    dst_dicom_dir_path: str,
+    file_rel_paths: list[str],
+    patient_name: str,
+    workers: int,
+    progress: Generator[None, None, None],
+    file_copied_callback: Callable[[str, int], None],
+) -> None:
+    """
+    Utility function for `copy_dicom_dir_patch_patient_name` that patches and copies the files
+    using a process pool.
+    """
+
+    errors = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _copy_dicom_file_patch_patient_name,
+                os.path.join(src_dicom_dir_path, file_rel_path),
+                os.path.join(dst_dicom_dir_path, file_rel_path),
+                patient_name,
+            ): file_rel_path
+            for file_rel_path in file_rel_paths
+        }
+
+        for future in as_completed(futures):
+            next(progress)
+            exception = future.exception()
+            if exception is not None:
+                errors += 1
+                print_error(f"Cannot copy file '{futures[future]}'. Full error:\n{exception}")
+            else:
+                file_copied_callback(futures[future], future.result())
+
+    if errors != 0:
+        print_error_exit(f"{errors} files of '{src_dicom_dir_path}' could not be copied.")
+
+
+def _copy_dicom_file_patch_patient_name(src_file_path: str, dst_file_path: str, patient_name: str) -> int:
+    """
+    Copy a file, renaming its DICOM patient name attribute if that file is a DICOM file, and
+    return the size of the copied file. The file is written to a temporary file that is renamed
+    once complete, so that an interrupted copy never leaves a partial file.
+    """
+
+    dst_dir_path, dst_file_name = os.path.split(dst_file_path)
+    tmp_file_path = os.path.join(dst_dir_path, f'.{dst_file_name}.part')
+
+    with open(src_file_path, 'rb') as src_file:
+        if not _read_dicom_preamble(src_file):
+            shutil.copyfile(src_file_path, tmp_file_path)
+            return _replace_file(tmp_file_path, dst_file_path)
+
+        splice = _find_patient_name_splice(src_file, patient_name)
+        if splice is not None:
+            _write_spliced_file(src_file, tmp_file_path, splice)
+            return _replace_file(tmp_file_path, dst_file_path)
+
+    # Fall back to decoding and re-encoding the whole DICOM file for the files that cannot be
+    # spliced.
+    ds = pydicom.dcmread(src_file_path)  # type: ignore
+    ds.PatientName = patient_name
+    ds.save_as(tmp_file_path)
+    return _replace_file(tmp_file_path, dst_file_path)
+
+
+def _replace_file(tmp_file_path: str, dst_file_path: str) -> int:
+    """
+    Move a complete temporary file to its destination path, and return its size.
+    """
+
+    file_size = os.path.getsize(tmp_file_path)
+    os.replace(tmp_file_path, dst_file_path)
+    return file_size
+
+
+def _read_dicom_copy_journal(journal_path: str) -> dict[str, int]:
+    """
+    Read the journal of a DICOM directory copy, and return the size of each file recorded as
+    copied in that journal.
+    """
+
+    copied_files: dict[str, int] = {}
+
+    if not os.path.exists(journal_path):
+        return copied_files
+
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            # Ignore a last line that was not entirely written.
+            if not line.endswith('\n'):
+                break
+
+            file_size, file_rel_path = line[:-1].split('\t', 1)
+            copied_files[file_rel_path] = int(file_size)
+
+    return copied_files
+
+
+def _get_file_size_or_none(file_path: str) -> int | None:
+    """
+    Get the size of a file in bytes, or `None` if that file does not exist.
+    """
+
+    try:
+        return os.path.getsize(file_path)
+    except FileNotFoundError:
+        return None
+
+
+def _add_dicom_file_patch_patient_name(
+    tar: tarfile.TarFile,
+    src_file_path: str,
+    arc_file_path: str,
+    patient_name: str,
+) -> None:
+    """
+    Add a file to a tar archive, renaming its DICOM patient name attribute if that file is a DICOM
+    file.
+    """
+
+    tar_info = tar.gettarinfo(src_file_path, arc_file_path)
+    if not tar_info.isreg():
+        tar.addfile(tar_info)
+        return
+
+    with open(src_file_path, 'rb') as src_file:
+        if not _read_dicom_preamble(src_file):
+            src_file.seek(0)
+            tar.addfile(tar_info, src_file)
+            return
+
+        splice = _find_patient_name_splice(src_file, patient_name)
+        if splice is not None:
+            tar_info.size += len(splice.element) - splice.length
+            tar.addfile(tar_info, _SplicedFileReader(src_file, splice))
+            return
+
+    # Fall back to re-encoding the DICOM file in memory for the files that cannot be spliced.
+    ds = pydicom.dcmread(src_file_path)  # type: ignore
+    ds.PatientName = patient_name
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    tar_info.size = buffer.tell()
+    buffer.seek(0)
+    tar.addfile(tar_info, buffer)
+
+
+@dataclass
+class _PatientNameSplice:
+    """
+    The location of the patient name attribute in a DICOM file, and the bytes that should replace
+    it.
+    """
+
+    offset: int
+    """
+    Offset of the patient name element in the file, or offset at which that element should be
+    inserted if the file has no patient name.
+    """
+
+    length: int
+    """
+    Length of the original patient name element in the file, including its header.
+    """
+
+    element: bytes
+    """
+    New patient name element, including its header.
+    """
+
+
+class _SplicedFileReader:
+    """
+    Readable stream of a DICOM file with its patient name element replaced, which reads the
+    original file on demand without buffering it.
+    """
+
+    def __init__(self, file: BinaryIO, splice: _PatientNameSplice):
+        self._fd = file.fileno()
+        self._splice = splice
+        self._size = os.fstat(self._fd).st_size + len(splice.element) - splice.length
+        self._position = 0
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read up to `size` bytes from the stream, or all the remaining bytes if `size` is negative.
+        """
+
+        if size < 0:
+            size = self._size - self._position
+
+        chunks: list[bytes] = []
+        while size > 0 and self._position < self._size:
+            chunk = self._read_chunk(size)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._position += len(chunk)
+
+        return b''.join(chunks)
+
+    def _read_chunk(self, size: int) -> bytes:
+        """
+        Read bytes from the current position up to the end of the current segment, which is
+        either the bytes before the patient name, the new patient name element, or the rest of the
+        original file.
+        """
+
+        element_start = self._splice.offset
+        element_end = self._splice.offset + len(self._splice.element)
+
+        if self._position < element_start:
+            return os.pread(self._fd, min(size, element_start - self._position), self._position)
+
+        if self._position < element_end:
+            start = self._position - element_start
+            return self._splice.element[start:start + size]
+
+        return os.pread(self._fd, size, self._position - len(self._splice.element) + self._splice.length)
+
+
+_PATIENT_NAME_TAG = (0x0010, 0x0010)
+
+_IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+_EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+_DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+
+# Explicit VRs whose elements have two reserved bytes followed by a 4-byte length.
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def _summarize_dicom_file(file_path: str) -> tuple[str, str | None, str | None, int | None, int] | None:
+    """
+    Utility function for `summarize_dicom_study` that reads the series information, instance
+    number, and size of a DICOM file, or return `None` if the file is not a DICOM file.
+    """
+
+    ds = read_dicom_tags(file_path, ['SeriesInstanceUID', 'SeriesDescription', 'Modality', 'InstanceNumber'])
+    if ds is None:
+        return None
+
+    series_description = ds.get('SeriesDescription')
+    modality = ds.get('Modality')
+    instance_number = ds.get('InstanceNumber')
+    return (
+        str(ds.get('SeriesInstanceUID', '')),
+        str(series_description) if series_description is not None else None,
+        str(modality) if modality is not None else None,
+        int(instance_number) if instance_number is not None and instance_number != '' else None,
+        os.path.getsize(file_path),
+    )
+
+
+def _read_dicom_preamble(file: BinaryIO) -> bool:
+    """
+    Read the 128-byte preamble and the prefix of a file in a single read, and return whether that
+    file is a DICOM file.
+    """
+
+    return file.read(132)[128:] == b'DICM'
+
+
+def _write_spliced_file(src_file: BinaryIO, dst_file_path: str, splice: _PatientNameSplice):
+    """
+    Write a copy of a DICOM file with its patient name element replaced, streaming the rest of the
+    file unchanged.
+    """
+
+    src_size = os.fstat(src_file.fileno()).st_size
+    with open(dst_file_path, 'wb', buffering=0) as dst_file:
+        copy_file_bytes(src_file.fileno(), dst_file.fileno(), 0, splice.offset)
+        dst_file.write(splice.element)
+        rest_offset = splice.offset + splice.length
+        copy_file_bytes(src_file.fileno(), dst_file.fileno(), rest_offset, src_size - rest_offset)
+
+
+def _find_patient_name_splice(file: BinaryIO, patient_name: str) -> _PatientNameSplice | None:
+    """
+    Parse the header of a DICOM file, positioned after its preamble, up to its patient name
+    attribute without reading the values of the other elements, and return the splice that
+    rewrites that attribute, or `None` if the file uses a structure that is not supported by the
+    splicer.
+    """
+
+    try:
+        patient_name_value = patient_name.encode('ascii')
+    except UnicodeEncodeError:
+        return None
+
+    # Values with an even length are required by DICOM, person names are padded with a space.
+    if len(patient_name_value) % 2 != 0:
+        patient_name_value += b' '
+
+    # Read the file meta information, which is always encoded in explicit VR little endian.
+    transfer_syntax_uid = None
+    while True:
+        offset = file.tell()
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+
+        group, element, vr = struct.unpack('<HH2s', header[:6])
+        if group != 0x0002:
+            file.seek(offset)
+            break
+
+        length = _read_explicit_vr_length(file, header, vr)
+        if length is None or length == _UNDEFINED_LENGTH:
+            return None
+
+        if element == 0x0010:
+            transfer_syntax_uid = file.read(length).rstrip(b'\0 ').decode('ascii', errors='replace')
+        else:
+            file.seek(length, os.SEEK_CUR)
+
+    if transfer_syntax_uid is None:
+        return None
+
+    if transfer_syntax_uid in (_EXPLICIT_VR_BIG_ENDIAN, _DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN):
+        return None
+
+    is_implicit_vr = transfer_syntax_uid == _IMPLICIT_VR_LITTLE_ENDIAN
+
+    if is_implicit_vr:
+        patient_name_header = struct.pack('<HHI', *_PATIENT_NAME_TAG, len(patient_name_value))
+    else:
+        if len(patient_name_value) > 0xFFFF:
+            return None
+
+        patient_name_header = struct.pack('<HH2sH', *_PATIENT_NAME_TAG, b'PN', len(patient_name_value))
+
+    new_element = patient_name_header + patient_name_value
+
+    # Skip the top-level data elements until the patient name attribute is found.
+    while True:
+        offset = file.tell()
+        header = file.read(8)
+        if len(header) < 8:
+            if len(header) != 0:
+                return None
+
+            return _PatientNameSplice(offset, 0, new_element)
+
+        tag = struct.unpack('<HH', header[:4])
+
+        # The group length would no longer be valid if the patient name length changed.
+        if tag == (_PATIENT_NAME_TAG[0], 0x0000):
+            return None
+
+        if tag > _PATIENT_NAME_TAG:
+            return _PatientNameSplice(offset, 0, new_element)
+
+        if is_implicit_vr:
+            length = struct.unpack('<I', header[4:])[0]
+        else:
+            length = _read_explicit_vr_length(file, header, header[4:6])
+            if length is None:
+                return None
+
+        if length == _UNDEFINED_LENGTH:
+            return None
+
+        if tag == _PATIENT_NAME_TAG:
+            return _PatientNameSplice(offset, file.tell() + length - offset, new_element)
+
+        file.seek(length, os.SEEK_CUR)
+
+
+def _read_explicit_vr_length(file: BinaryIO, header: bytes, vr: bytes) -> int | None:
+    """
+    Get the value length of an explicit VR data element from its 8 first bytes, reading the
+    additional length bytes from the file if the VR requires it. Return `None` if the VR is not
+    valid, which happens if the file does not actually use explicit VR.
+    """
+
+    if not (vr.isalpha() and vr.isupper()):
+        return None
+
+    if vr in _LONG_LENGTH_VRS:
+        length_bytes = file.read(4)
+        if len(length_bytes) < 4:
+            return None
+
+        return struct.unpack('<I', length_bytes)[0]
 
-            ds = pydicom.dcmread(src_file_path)  # type: ignore
-            ds.PatientName = patient_name
-            ds.save_as(dst_file_path)
+    return struct.unpack('<H', header[6:])[0]
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import tempfile
+from array import array
+from collections.abc import Generator, Iterable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TextIO
+
+from bic_util.checksum import hash_file_sha256
+from bic_util.dicom import read_dicom_tags
+from bic_util.fs import scan_dir
+from bic_util.util import map_bounded
+
+
+@dataclass
+class DicomInstanceFile:
+    """
+    A DICOM file containing a given SOP instance.
+    """
+
+    path: str
+    size: int
+
+    sha256: str | None
+    """
+    SHA-256 hash of the file content, if content hashing is enabled.
+    """
+
+
+@dataclass
+class DicomDuplicateInstance:
+    """
+    A DICOM SOP instance found in several DICOM files.
+    """
+
+    sop_instance_uid: str
+    files: list[DicomInstanceFile]
+
+    conflict: bool
+    """
+    Whether the files of this instance have different sizes or, if content hashing is enabled,
+    different content.
+    """
+
+
+def find_duplicate_dicom_instances(
+    dicom_study_paths: Iterable[str],
+    hash_content: bool = False,
+    workers: int = 8,
+    tmp_dir_path: str | None = None,
+) -> Generator[DicomDuplicateInstance, None, None]:
+    """
+    Scan DICOM studies and yield the SOP instances found in more than one DICOM file, using a pool
+    of `workers` threads to read the DICOM headers and optionally hash the file contents.
+
+    The memory usage is bounded regardless of the number of instances: the scanned instances are
+    spilled to temporary bucket files partitioned by UID hash, and each bucket is then checked for
+    duplicates using a sorted array of 64-bit UID hashes.
+    """
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir_path) as buckets_dir_path:
+        bucket_paths = [os.path.join(buckets_dir_path, f'{i}.tsv') for i in range(_BUCKETS_COUNT)]
+        bucket_files = [open(bucket_path, 'w') for bucket_path in bucket_paths]
+
+        try:
+            _scan_dicom_instances(dicom_study_paths, hash_content, workers, bucket_files)
+        finally:
+            for bucket_file in bucket_files:
+                bucket_file.close()
+
+        for bucket_path in bucket_paths:
+            yield from _find_bucket_duplicates(bucket_path, hash_content)
+
+
+_BUCKETS_COUNT = 256
+
+
+def _scan_dicom_instances(
+    dicom_study_paths: Iterable[str],
+    hash_content: bool,
+    workers: int,
+    bucket_files: Sequence[TextIO],
+):
+    """
+    Read the SOP instance UID of each DICOM file of the DICOM studies, and write each instance in
+    the bucket file that corresponds to its UID hash.
+    """
+
+    file_paths = (
+        os.path.join(dicom_study_path, file.path)
+        for dicom_study_path in dicom_study_paths
+        for file in scan_dir(dicom_study_path, workers=workers).files
+    )
+
+    def read_instance(file_path: str) -> tuple[str, str] | None:
+        ds = read_dicom_tags(file_path, ['SOPInstanceUID'])
+        if ds is None or 'SOPInstanceUID' not in ds:
+            return None
+
+        sop_instance_uid = str(ds.SOPInstanceUID)
+        size = os.path.getsize(file_path)
+        sha256 = hash_file_sha256(file_path) if hash_content else ''
+        return sop_instance_uid, f'{sop_instance_uid}\t{size}\t{sha256}\t{file_path}\n'
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for instance in map_bounded(executor, read_instance, file_paths, workers * 4):
+            if instance is None:
+                continue
+
+            sop_instance_uid, line = instance
+            bucket_files[_hash_uid(sop_instance_uid) % _BUCKETS_COUNT].write(line)
+
+
+def _find_bucket_duplicates(bucket_path: str, hash_content: bool) -> Generator[DicomDuplicateInstance, None, None]:
+    """
+    Find the duplicate instances of a bucket file. A first pass only keeps the UID hashes in a
+    compact array to find the duplicate candidates, a second pass then groups the files of these
+    candidates by UID.
+    """
+
+    uid_hashes = array('Q')
+    with open(bucket_path) as bucket_file:
+        for line in bucket_file:
+            uid_hashes.append(_hash_uid(line[:line.index('\t')]))
+
+    sorted_uid_hashes = sorted(uid_hashes)
+    del uid_hashes
+    candidate_uid_hashes = {
+        uid_hash
+        for i, uid_hash in enumerate(sorted_uid_hashes[1:])
+        if uid_hash == sorted_uid_hashes[i]
+    }
+
+    del sorted_uid_hashes
+    if not candidate_uid_hashes:
+        return
+
+    candidates: dict[str, list[DicomInstanceFile]] = {}
+    with open(bucket_path) as bucket_file:
+        for line in bucket_file:
+            sop_instance_uid, size, sha256, path = line[:-1].split('\t', 3)
+            if _hash_uid(sop_instance_uid) not in candidate_uid_hashes:
+                continue
+
+            candidates.setdefault(sop_instance_uid, []).append(
+                DicomInstanceFile(path, int(size), sha256 if hash_content else None)
+            )
+
+    for sop_instance_uid, files in candidates.items():
+        # Different UIDs can share the same hash.
+        if len(files) < 2:
+            continue
+
+        conflict = len({(file.size, file.sha256) for file in files}) > 1
+        yield DicomDuplicateInstance(sop_instance_uid, files, conflict)
+
+
+def _hash_uid(uid: str) -> int:
+    """
+    Get a 64-bit hash of a UID that is stable across processes.
+    """
+
+    return int.from_bytes(hashlib.blake2b(uid.encode(), digest_size=8).digest())
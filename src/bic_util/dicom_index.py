@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from bic_util.dicom import read_dicom_tags
+from bic_util.fs import scan_dir
+from bic_util.print import print_warning
+
+DICOM_INDEX_TAGS = [
+    'PatientName',
+    'PatientID',
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'SOPInstanceUID',
+    'Modality',
+]
+"""
+DICOM tags whose values are stored in the DICOM header index, in addition to the transfer syntax.
+"""
+
+
+@dataclass
+class DicomIndex:
+    """
+    An on-disk index of the DICOM headers of a DICOM study, stored in an SQLite database.
+    """
+
+    dicom_study_path: str
+    """
+    Path of the indexed DICOM study.
+    """
+
+    index_path: str
+    """
+    Path of the SQLite database file of the index.
+    """
+
+    connection: sqlite3.Connection
+    """
+    Open connection to the SQLite database of the index.
+    """
+
+
+@dataclass
+class DicomIndexEntry:
+    """
+    The indexed header fields of a DICOM file.
+    """
+
+    path: str
+    """
+    Path of the file relative to the DICOM study.
+    """
+
+    size: int
+    mtime_ns: int
+    patient_name: str | None
+    patient_id: str | None
+    study_instance_uid: str | None
+    series_instance_uid: str | None
+    sop_instance_uid: str | None
+    modality: str | None
+    transfer_syntax_uid: str | None
+
+
+def get_default_dicom_index_path(dicom_study_path: str) -> str:
+    """
+    Get the default path of the index of a DICOM study, which is located in the user cache
+    directory.
+    """
+
+    cache_dir_path = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    study_hash = hashlib.sha256(os.path.abspath(dicom_study_path).encode()).hexdigest()[:32]
+    return os.path.join(cache_dir_path, 'bic_util', 'dicom_index', f'{study_hash}.sqlite')
+
+
+def open_dicom_index(dicom_study_path: str, index_path: str | None = None) -> DicomIndex:
+    """
+    Open or create the index of a DICOM study. The index is stored in the user cache directory if
+    no index path is provided. The index is not refreshed by this function.
+    """
+
+    if index_path is None:
+        index_path = get_default_dicom_index_path(dicom_study_path)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+    connection = sqlite3.connect(index_path)
+    connection.executescript(_DICOM_INDEX_SCHEMA)
+    return DicomIndex(dicom_study_path, index_path, connection)
+
+
+def close_dicom_index(dicom_index: DicomIndex) -> None:
+    """
+    Close the database connection of a DICOM index.
+    """
+
+    dicom_index.connection.close()
+
+
+def refresh_dicom_index(dicom_index: DicomIndex, workers: int = 8) -> None:
+    """
+    Update a DICOM index with the current state of its DICOM study. Only the headers of the files
+    that are new or whose size or modification time changed are read, using a pool of `workers`
+    threads.
+    """
+
+    connection = dicom_index.connection
+
+    indexed_files: dict[str, tuple[int, int]] = {
+        path: (size, mtime_ns) for path, size, mtime_ns in connection.execute('SELECT path, size, mtime_ns FROM files')
+    }
+
+    changed_files: list[tuple[str, int, int]] = []
+    for file in scan_dir(dicom_index.dicom_study_path, workers=workers).files:
+        if indexed_files.pop(file.path, None) != (file.size, file.mtime_ns):
+            changed_files.append((file.path, file.size, file.mtime_ns))
+
+    def read_row(file: tuple[str, int, int]) -> tuple[str | int | None, ...]:
+        path, size, mtime_ns = file
+        return (path, size, mtime_ns, *_read_index_fields(os.path.join(dicom_index.dicom_study_path, path)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(read_row, changed_files))
+
+    with connection:
+        connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in indexed_files])
+        connection.executemany(f'INSERT OR REPLACE INTO files VALUES ({", ".join("?" * _FILES_COLUMNS_COUNT)})', rows)
+
+
+def get_dicom_index_entries(
+    dicom_index: DicomIndex,
+    patient_name: str | None = None,
+    study_instance_uid: str | None = None,
+    series_instance_uid: str | None = None,
+    modality: str | None = None,
+) -> list[DicomIndexEntry]:
+    """
+    Get the indexed DICOM files of a DICOM index, optionally filtered by the given header values.
+    """
+
+    filters = {
+        'patient_name': patient_name,
+        'study_instance_uid': study_instance_uid,
+        'series_instance_uid': series_instance_uid,
+        'modality': modality,
+    }
+
+    conditions = ['is_dicom = 1']
+    parameters: list[str] = []
+    for column, value in filters.items():
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            parameters.append(value)
+
+    cursor = dicom_index.connection.execute(
+        f'SELECT {_ENTRY_COLUMNS} FROM files WHERE {" AND ".join(conditions)} ORDER BY path',
+        parameters,
+    )
+
+    return [DicomIndexEntry(*row) for row in cursor]
+
+
+def get_dicom_index_patient_name(dicom_index: DicomIndex) -> str | None:
+    """
+    Get the patient name of a DICOM file of an indexed DICOM study.
+    """
+
+    row = dicom_index.connection.execute(
+        'SELECT patient_name FROM files WHERE is_dicom = 1 AND patient_name IS NOT NULL LIMIT 1'
+    ).fetchone()
+
+    return row[0] if row is not None else None
+
+
+def get_dicom_index_series_instance_uids(dicom_index: DicomIndex) -> list[str]:
+    """
+    Get the distinct series instance UIDs of an indexed DICOM study.
+    """
+
+    cursor = dicom_index.connection.execute(
+        'SELECT DISTINCT series_instance_uid FROM files WHERE series_instance_uid IS NOT NULL ORDER BY 1'
+    )
+
+    return [row[0] for row in cursor]
+
+
+_DICOM_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path                TEXT PRIMARY KEY,
+    size                INTEGER NOT NULL,
+    mtime_ns            INTEGER NOT NULL,
+    is_dicom            INTEGER NOT NULL,
+    patient_name        TEXT,
+    patient_id          TEXT,
+    study_instance_uid  TEXT,
+    series_instance_uid TEXT,
+    sop_instance_uid    TEXT,
+    modality            TEXT,
+    transfer_syntax_uid TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_patient_name ON files (patient_name);
+CREATE INDEX IF NOT EXISTS files_study_instance_uid ON files (study_instance_uid);
+CREATE INDEX IF NOT EXISTS files_series_instance_uid ON files (series_instance_uid);
+CREATE INDEX IF NOT EXISTS files_sop_instance_uid ON files (sop_instance_uid);
+'''
+
+# Path, size, modification time, DICOM flag, header tags, and transfer syntax.
+_FILES_COLUMNS_COUNT = 4 + len(DICOM_INDEX_TAGS) + 1
+
+_ENTRY_COLUMNS = (
+    'path, size, mtime_ns, patient_name, patient_id, study_instance_uid, series_instance_uid, sop_instance_uid, '
+    'modality, transfer_syntax_uid'
+)
+
+
+def _read_index_fields(file_path: str) -> tuple[str | int | None, ...]:
+    """
+    Read the indexed header fields of a file, starting with whether that file is a DICOM file.
+    """
+
+    try:
+        ds = read_dicom_tags(file_path, DICOM_INDEX_TAGS)
+    except Exception as error:
+        print_warning(f"Cannot read the DICOM header of file '{file_path}'. Full error:\n{error}")
+        ds = None
+
+    if ds is None:
+        return (0, *([None] * (len(DICOM_INDEX_TAGS) + 1)))
+
+    values = [str(ds[tag].value) if tag in ds else None for tag in DICOM_INDEX_TAGS]
+    transfer_syntax_uid = ds.file_meta.get('TransferSyntaxUID')
+    return (1, *values, str(transfer_syntax_uid) if transfer_syntax_uid is not None else None)
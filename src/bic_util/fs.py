@@ -1,9 +1,33 @@
+import errno
+import fcntl
+import fnmatch
+import gzip
+import importlib
+import lzma
 import os
+import shutil
 import tarfile
-from collections.abc import Generator
+from collections import deque
+from collections.abc import Callable, Generator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
+from typing import BinaryIO, Literal, cast
 
-from bic_util.print import get_progress_printer, print_error_exit
+from bic_util.print import get_file_size_progress_printer, print_error_exit
+
+LinkMode = Literal['copy', 'hardlink', 'reflink', 'symlink', 'auto']
+"""
+Method used to copy a file:
+- `copy`: Copy the file data.
+- `hardlink`: Create a hard link to the source file, or copy the file data if that is not possible.
+- `reflink`: Create a copy-on-write clone of the source file, or copy the file data using
+  `copy_file_range` if that is not possible.
+- `symlink`: Create a symbolic link to the absolute path of the source file.
+- `auto`: Create a copy-on-write clone, or a hard link, or copy the file data, using the first
+  method supported by the file system.
+"""
 
 
 def require_directory(dir_path: str):
@@ -128,12 +152,198 @@ def rename_file(old_path: Path, new_name: str):
     old_path.rename(new_path)
 
 
+def copy_file_bytes(src_fd: int, dst_fd: int, offset: int, count: int):
+    """
+    Copy a range of bytes of a source file to the current position of a destination file, using
+    in-kernel copies (`copy_file_range` or `sendfile`) when the platform supports them.
+    """
+
+    end = offset + count
+
+    # Try the in-kernel copy functions first, from the most to the least efficient.
+    for copy_function in (_copy_file_range, _sendfile):
+        try:
+            while offset < end:
+                copied = copy_function(src_fd, dst_fd, offset, end - offset)
+                if copied == 0:
+                    return
+
+                offset += copied
+
+            return
+        except OSError as error:
+            if error.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    while offset < end:
+        data = os.pread(src_fd, min(_COPY_BUFFER_SIZE, end - offset), offset)
+        if not data:
+            return
+
+        os.write(dst_fd, data)
+        offset += len(data)
+
+
+def copy_file_link(src_file_path: str, dst_file_path: str, link_mode: LinkMode = 'copy'):
+    """
+    Copy a file using the given link mode, falling back to copying the file data when the file
+    system does not support that mode.
+    """
+
+    match link_mode:
+        case 'copy':
+            shutil.copy(src_file_path, dst_file_path)
+        case 'hardlink':
+            if not _try_hardlink_file(src_file_path, dst_file_path):
+                shutil.copy(src_file_path, dst_file_path)
+        case 'reflink':
+            if not _try_reflink_file(src_file_path, dst_file_path):
+                _copy_file_data(src_file_path, dst_file_path)
+        case 'symlink':
+            os.symlink(os.path.abspath(src_file_path), dst_file_path)
+        case 'auto':
+            if not _try_reflink_file(src_file_path, dst_file_path) \
+                    and not _try_hardlink_file(src_file_path, dst_file_path):
+                _copy_file_data(src_file_path, dst_file_path)
+
+
+@dataclass
+class DirSnapshotFile:
+    """
+    A file listed in a directory snapshot.
+    """
+
+    path: str
+    """
+    Path of the file relative to the snapshot directory.
+    """
+
+    size: int
+    mtime_ns: int
+
+    nlink: int = 1
+    dev: int = 0
+    ino: int = 0
+    blocks: int = 0
+    """
+    Number of hard links, device and inode numbers, and number of allocated 512-byte blocks of the
+    file, which are only known for the files listed by `scan_dir`.
+    """
+
+
+@dataclass
+class DirSnapshot:
+    """
+    The subdirectories and the files of a directory, listed recursively by a single traversal so
+    that they can be counted and iterated several times.
+    """
+
+    path: str
+    """
+    Path of the snapshot directory.
+    """
+
+    dir_paths: list[str]
+    """
+    Paths of the subdirectories relative to the snapshot directory, sorted so that each directory
+    comes before its subdirectories, starting with the snapshot directory itself as an empty path.
+    """
+
+    files: list[DirSnapshotFile]
+    """
+    Files of the directory, sorted by relative path.
+    """
+
+    dir_links: list[DirSnapshotFile]
+    """
+    Symbolic links to directories found in the directory, sorted by relative path, with the
+    information of the links themselves. These links are not followed, and are listed separately
+    from the files so that only the functions that can recreate them, such as archiving ones, need
+    to handle them.
+    """
+
+
+def scan_dir(
+    dir_path: str,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+    workers: int = 8,
+    follow_symlinks: bool = True,
+) -> DirSnapshot:
+    """
+    List the subdirectories and the files of a directory recursively, listing the subdirectories
+    in parallel using a pool of `workers` threads, and using the file information cached by
+    `os.scandir`.
+
+    If `include` is provided, only the files whose relative path matches one of its glob patterns
+    are listed. The files and directories whose relative path matches a glob pattern of `exclude`
+    are not listed, and the excluded directories are not traversed. Symbolic links to directories
+    are not followed, and are listed separately from the files. If `follow_symlinks` is not set,
+    the symbolic links to files are listed with the information of the link itself.
+    """
+
+    dir_paths: list[str] = []
+    files: list[DirSnapshotFile] = []
+    dir_links: list[DirSnapshotFile] = []
+
+    def is_excluded(rel_path: str) -> bool:
+        return exclude is not None and any(fnmatch.fnmatch(rel_path, pattern) for pattern in exclude)
+
+    def is_included(rel_path: str) -> bool:
+        return include is None or any(fnmatch.fnmatch(rel_path, pattern) for pattern in include)
+
+    def scan_sub_dir(sub_dir_rel_path: str) -> tuple[list[str], list[DirSnapshotFile], list[DirSnapshotFile]]:
+        sub_dir_rel_paths: list[str] = []
+        sub_dir_files: list[DirSnapshotFile] = []
+        sub_dir_links: list[DirSnapshotFile] = []
+        with os.scandir(os.path.join(dir_path, sub_dir_rel_path)) as iterator:
+            for entry in iterator:
+                entry_rel_path = os.path.join(sub_dir_rel_path, entry.name)
+                if is_excluded(entry_rel_path):
+                    continue
+
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dir_rel_paths.append(entry_rel_path)
+                elif is_included(entry_rel_path):
+                    is_dir_link = entry.is_dir()
+                    entry_stat = entry.stat(follow_symlinks=follow_symlinks and entry.is_file())
+                    (sub_dir_links if is_dir_link else sub_dir_files).append(DirSnapshotFile(
+                        entry_rel_path,
+                        entry_stat.st_size,
+                        entry_stat.st_mtime_ns,
+                        entry_stat.st_nlink,
+                        entry_stat.st_dev,
+                        entry_stat.st_ino,
+                        entry_stat.st_blocks,
+                    ))
+
+        return sub_dir_rel_paths, sub_dir_files, sub_dir_links
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        dir_paths.append('')
+        pending = {executor.submit(scan_sub_dir, '')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sub_dir_rel_paths, sub_dir_files, sub_dir_links = future.result()
+                dir_paths.extend(sub_dir_rel_paths)
+                files.extend(sub_dir_files)
+                dir_links.extend(sub_dir_links)
+                for sub_dir_rel_path in sub_dir_rel_paths:
+                    pending.add(executor.submit(scan_sub_dir, sub_dir_rel_path))
+
+    dir_paths.sort()
+    files.sort(key=lambda file: file.path)
+    dir_links.sort(key=lambda dir_link: dir_link.path)
+    return DirSnapshot(dir_path, dir_paths, files, dir_links)
+
+
 def count_all_dir_files(dir_path: str) -> int:
     """
     Count the number of files in a directory recursively.
     """
 
-    return sum([len(file_names) for _, _, file_names in os.walk(dir_path)])
+    return len(scan_dir(dir_path).files)
 
 
 def iter_all_dir_files(dir_path: str) -> Generator[str, None, None]:
@@ -142,26 +352,222 @@ def iter_all_dir_files(dir_path: str) -> Generator[str, None, None]:
     relative to that directory.
     """
 
-    for sub_dir_path, _, file_names in os.walk(dir_path):
-        for file_name in file_names:
-            file_path = os.path.join(sub_dir_path, file_name)
-            yield os.path.relpath(file_path, start=dir_path)
+    for file in scan_dir(dir_path).files:
+        yield file.path
+
+
+TarCompression = Literal['gz', 'xz', 'zst']
+"""
+Compression format of a tar file: gzip, xz, or zstd. The zstd format requires either Python 3.14 or
+the `zstandard` package.
+"""
 
 
-def tar_with_progress(file_path: str, tar_path: str, file_alias: str | None = None):
+def tar_with_progress(
+    file_path: str,
+    tar_path: str | BinaryIO,
+    file_alias: str | None = None,
+    compression: TarCompression | None = None,
+    workers: int = 8,
+    progress_callback: Callable[[int], None] | None = None,
+):
     """
-    Archive a file or directory into a tar file, printing progress while doing so.
+    Archive a file or directory into a tar file or a writable binary stream, printing progress
+    while doing so, or calling the progress callback with the size of each archived file if one is
+    provided.
+
+    If a compression format is provided, the tar stream is split into blocks that are compressed
+    in parallel using a pool of `workers` threads. Each block is written as an independent gzip
+    member, xz stream, or zstd frame, which concatenated form a standard compressed file that can
+    be read by `tar`.
     """
 
     file_name = os.path.basename(file_path)
     arc_name = file_alias if file_alias is not None else file_name
-    progress = get_progress_printer(count_all_dir_files(file_path))
-    with tarfile.open(tar_path, 'w') as tar:
-        tar.add(
-            file_path,
-            arcname=arc_name,
-            filter=lambda x: next(progress) or x
-        )
+
+    compress = _get_block_compressor(compression) if compression is not None else None
+
+    with open(tar_path, 'wb') if isinstance(tar_path, str) else nullcontext(tar_path) as tar_file:
+        if compress is None:
+            _tar_with_progress(file_path, tar_file, arc_name, progress_callback)
+            return
+
+        compressed_writer = _ParallelCompressedWriter(tar_file, compress, workers)
+        try:
+            # The tar stream mode only writes to its file object.
+            _tar_with_progress(file_path, cast(BinaryIO, compressed_writer), arc_name, progress_callback)
+        finally:
+            compressed_writer.close()
+
+
+def extract_tar_stream(
+    tar_file: BinaryIO,
+    dir_path: str,
+    compression: TarCompression | None = None,
+    progress_callback: Callable[[int], None] | None = None,
+):
+    """
+    Extract a tar stream read sequentially from a readable binary stream into a directory, calling
+    the progress callback with the size of each extracted file if one is provided. The members that
+    would be extracted outside of that directory or that are not regular files, directories or
+    links are rejected.
+    """
+
+    # The compressed streams written by `tar_with_progress` are made of several gzip members, xz
+    # streams, or zstd frames, which the compressed modes of `tarfile` stop reading after the first
+    # one, unlike the file objects of the compression modules.
+    match compression:
+        case None:
+            pass
+        case 'gz':
+            tar_file = cast(BinaryIO, gzip.GzipFile(fileobj=tar_file, mode='rb'))
+        case 'xz':
+            tar_file = cast(BinaryIO, lzma.LZMAFile(tar_file))
+        case 'zst':
+            tar_file = _get_zstd_stream_reader(tar_file)
+
+    with tarfile.open(fileobj=tar_file, mode='r|') as tar:
+        for member in tar:
+            tar.extract(member, dir_path, filter='data')
+            if progress_callback is not None and member.isfile():
+                progress_callback(member.size)
+
+
+def _tar_with_progress(
+    file_path: str,
+    tar_file: BinaryIO,
+    arc_name: str,
+    progress_callback: Callable[[int], None] | None,
+):
+    """
+    Utility function for `tar_with_progress` that writes a tar stream to a file.
+    """
+
+    with tarfile.open(fileobj=tar_file, mode='w|') as tar:
+        if not os.path.isdir(file_path):
+            tar.add(file_path, arcname=arc_name)
+            if progress_callback is not None:
+                progress_callback(os.path.getsize(file_path))
+
+            return
+
+        snapshot = scan_dir(file_path)
+        if progress_callback is None:
+            progress_callback = get_file_size_progress_printer(
+                sum(file.size for file in snapshot.files),
+                len(snapshot.files),
+            )
+
+        for dir_rel_path in snapshot.dir_paths:
+            tar.add(
+                os.path.join(file_path, dir_rel_path),
+                arcname=os.path.normpath(os.path.join(arc_name, dir_rel_path)),
+                recursive=False,
+            )
+
+        for file in snapshot.files:
+            tar.add(os.path.join(file_path, file.path), arcname=os.path.join(arc_name, file.path))
+            progress_callback(file.size)
+
+        for dir_link in snapshot.dir_links:
+            tar.add(os.path.join(file_path, dir_link.path), arcname=os.path.join(arc_name, dir_link.path))
+
+
+class _ParallelCompressedWriter:
+    """
+    Writable stream that splits the written data into blocks, compresses these blocks in parallel
+    using a thread pool, and writes the compressed blocks in order to an underlying file. The
+    compression functions of the standard library release the GIL, which allows the blocks to be
+    compressed on several cores.
+    """
+
+    def __init__(self, file: BinaryIO, compress: Callable[[bytes], bytes], workers: int):
+        self._file = file
+        self._compress = compress
+        self._max_pending = workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending: deque[Future[bytes]] = deque()
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        """
+        Write data to the stream.
+        """
+
+        self._buffer += data
+        while len(self._buffer) >= _COMPRESSION_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:_COMPRESSION_BLOCK_SIZE]))
+            del self._buffer[:_COMPRESSION_BLOCK_SIZE]
+
+        return len(data)
+
+    def close(self):
+        """
+        Compress and write the remaining data of the stream. The underlying file is not closed.
+        """
+
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+
+        self._executor.shutdown()
+
+    def _submit(self, block: bytes):
+        """
+        Submit a block to the compression pool, writing the oldest compressed blocks first if too
+        many blocks are pending.
+        """
+
+        while len(self._pending) >= self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+        self._pending.append(self._executor.submit(self._compress, block))
+
+
+def _get_block_compressor(compression: TarCompression) -> Callable[[bytes], bytes]:
+    """
+    Get the function that compresses a block of a tar stream using a given compression format.
+    """
+
+    match compression:
+        case 'gz':
+            return lambda block: gzip.compress(block, _GZIP_COMPRESS_LEVEL, mtime=0)
+        case 'xz':
+            return lzma.compress
+        case 'zst':
+            for module_name in ('compression.zstd', 'zstandard'):
+                try:
+                    module = importlib.import_module(module_name)
+                except ImportError:
+                    continue
+
+                compress: Callable[[bytes], bytes] = module.compress
+                return compress
+
+            print_error_exit("The zstd compression requires Python 3.14 or the 'zstandard' package.")
+
+
+def _get_zstd_stream_reader(file: BinaryIO) -> BinaryIO:
+    """
+    Get a readable stream that decompresses a zstd stream of one or more frames read from a file.
+    """
+
+    try:
+        zstd = importlib.import_module('compression.zstd')
+        reader: BinaryIO = zstd.ZstdFile(file)
+        return reader
+    except ImportError:
+        pass
+
+    try:
+        zstandard = importlib.import_module('zstandard')
+        reader: BinaryIO = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
+        return reader
+    except ImportError:
+        print_error_exit("The zstd compression requires Python 3.14 or the 'zstandard' package.")
 
 
 def get_size(path: Path) -> int:
@@ -188,9 +594,174 @@ def get_directory_size(dir_path: Path) -> int:
     Get the size of a directory in bytes.
     """
 
-    total_size = 0
+    return get_directory_usage(str(dir_path)).total.apparent_size
+
+
+@dataclass
+class DiskUsage:
+    """
+    The disk usage of a set of files.
+    """
+
+    apparent_size: int
+    """
+    Sum of the sizes of the files in bytes.
+    """
+
+    allocated_size: int
+    """
+    Sum of the sizes of the disk blocks allocated to the files in bytes.
+    """
+
+    file_count: int
+
+
+@dataclass
+class DirectoryUsage:
+    """
+    The disk usage of a directory, along with the disk usage of each of its top-level entries.
+    """
+
+    total: DiskUsage
+    entries: dict[str, DiskUsage]
+
+
+def get_directory_usage(dir_path: str, workers: int = 8) -> DirectoryUsage:
+    """
+    Get the disk usage of the files of a directory recursively, traversing the subdirectories in
+    parallel using a pool of `workers` threads.
+
+    Symbolic links are not followed, and the files with several hard links are only counted once.
+    The sizes of the directories themselves are not counted.
+    """
+
+    snapshot = scan_dir(dir_path, workers=workers, follow_symlinks=False)
+
+    total = DiskUsage(0, 0, 0)
+    entries: dict[str, DiskUsage] = {}
+    for dir_rel_path in snapshot.dir_paths:
+        if dir_rel_path != '' and os.sep not in dir_rel_path:
+            entries[dir_rel_path] = DiskUsage(0, 0, 0)
+
+    seen_inodes: set[tuple[int, int]] = set()
+    for file in [*snapshot.files, *snapshot.dir_links]:
+        entry_name = file.path.split(os.sep, 1)[0]
+        entry_usage = entries.get(entry_name)
+        if entry_usage is None:
+            entry_usage = entries[entry_name] = DiskUsage(0, 0, 0)
+
+        # Only the files with several hard links need to be tracked to be counted once.
+        if file.nlink > 1:
+            inode = (file.dev, file.ino)
+            if inode in seen_inodes:
+                continue
+
+            seen_inodes.add(inode)
+
+        _add_disk_usage(entry_usage, file)
+
+    for entry_usage in entries.values():
+        total.apparent_size  += entry_usage.apparent_size
+        total.allocated_size += entry_usage.allocated_size
+        total.file_count     += entry_usage.file_count
+
+    return DirectoryUsage(total, entries)
+
+
+def _add_disk_usage(usage: DiskUsage, file: DirSnapshotFile):
+    """
+    Add the size of a file to a disk usage.
+    """
+
+    usage.apparent_size  += file.size
+    usage.allocated_size += file.blocks * 512
+    usage.file_count     += 1
+
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+_COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Default compression level of the `gzip` command, which is much faster than the maximum level
+# used by `gzip.compress` for a slightly larger output.
+_GZIP_COMPRESS_LEVEL = 6
+
+_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+# Linux `FICLONE` ioctl request, which clones a file on copy-on-write file systems.
+_FICLONE = 0x40049409
+
+_LINK_FALLBACK_ERRNOS = _COPY_FALLBACK_ERRNOS | {errno.ENOTTY, errno.EPERM, errno.EMLINK}
+
+
+def _try_hardlink_file(src_file_path: str, dst_file_path: str) -> bool:
+    """
+    Try to create a hard link to a file, and return whether the link was created.
+    """
+
+    try:
+        os.link(src_file_path, dst_file_path)
+        return True
+    except OSError as error:
+        if error.errno not in _LINK_FALLBACK_ERRNOS:
+            raise
+
+        return False
+
+
+def _try_reflink_file(src_file_path: str, dst_file_path: str) -> bool:
+    """
+    Try to clone a file using the `FICLONE` ioctl, and return whether the clone was created.
+    """
+
+    with open(src_file_path, 'rb') as src_file, open(dst_file_path, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError as error:
+            if error.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+
+            cloned = False
+        else:
+            cloned = True
+
+    if not cloned:
+        os.remove(dst_file_path)
+        return False
+
+    shutil.copymode(src_file_path, dst_file_path)
+    return True
+
+
+def _copy_file_data(src_file_path: str, dst_file_path: str):
+    """
+    Copy the data and permission bits of a file using `copy_file_bytes`.
+    """
+
+    with open(src_file_path, 'rb') as src_file, open(dst_file_path, 'wb', buffering=0) as dst_file:
+        copy_file_bytes(src_file.fileno(), dst_file.fileno(), 0, os.fstat(src_file.fileno()).st_size)
+
+    shutil.copymode(src_file_path, dst_file_path)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """
+    Utility function for `copy_file_bytes` that copies bytes using `copy_file_range`.
+    """
+
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available on this platform.")
+
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+    """
+    Utility function for `copy_file_bytes` that copies bytes using `sendfile`.
+    """
 
-    for entry in os.scandir(dir_path):
-        total_size += get_size(Path(entry.path))
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOSYS, "sendfile is not available on this platform.")
 
-    return total_size
+    return os.sendfile(dst_fd, src_fd, offset, count)
@@ -1,9 +1,12 @@
 import contextlib
 import io
 import sys
+import threading
 from collections.abc import Callable, Generator
 from typing import Never, TextIO, TypeVar
 
+from bic_util.format import format_file_size
+
 verbose_flag: bool = False
 
 COLOR_WARNING = '\033[93m'
@@ -116,6 +119,46 @@ def get_progress_printer(total: int) -> Generator[None, None, None]:
         yield None
 
 
+def get_file_size_progress_printer(total_size: int, total_files: int | None = None) -> Callable[[int], None]:
+    """
+    Get a function whose each call adds a number of bytes to a progress counter and prints that
+    counter up to the defined total size. If a total number of files is provided, each call also
+    increments a file counter that is printed along with the size counter. The function can be
+    called from several threads.
+    """
+
+    is_terminal = sys.stdout.isatty()
+    lock = threading.Lock()
+    progress = 0
+    files_progress = 0
+    printed_percent = 0
+
+    def format_progress() -> str:
+        size_progress = f"{format_file_size(progress)} / {format_file_size(total_size)}"
+        if total_files is None:
+            return size_progress
+
+        return f"{files_progress} / {total_files} files, {size_progress}"
+
+    def add_progress(size: int):
+        nonlocal progress, files_progress, printed_percent
+
+        with lock:
+            progress += size
+            files_progress += 1
+
+            # Do not print every step in a non-terminal output stream to not flood that stream.
+            if is_terminal:
+                print(format_progress(), end='\r')
+            else:
+                percent = progress * 100 // total_size if total_size != 0 else 100
+                if percent > printed_percent:
+                    printed_percent = percent
+                    print(format_progress())
+
+    return add_progress
+
+
 def print_with_color(output_stream: TextIO, message: str, color_code: str):
     """
     Print a message in an output stream using the given color code if that output stream is a
@@ -1,12 +1,23 @@
 import os
+import re
 import shlex
 import stat
-from collections.abc import Callable
+import tarfile
+import threading
+import time
+from collections.abc import Callable, Generator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import BinaryIO, Literal, TypeVar, cast
 
-from paramiko import SFTPClient, SSHClient
+from paramiko import Channel, ChannelFile, SFTPAttributes, SFTPClient, SSHClient, SSHException
 
-from bic_util.print import print_error_exit
+from bic_util.checksum import hash_file_sha256
+from bic_util.fs import DirSnapshotFile, DiskUsage, TarCompression, extract_tar_stream, scan_dir, tar_with_progress
+from bic_util.print import print_error_exit, print_warning
+
+T = TypeVar('T')
 
 
 @dataclass
@@ -19,181 +30,1252 @@ class SSHCommandResult:
     stdout: str
     stderr: str
 
+    truncated: bool = False
+    """
+    Whether the beginning of the standard output or standard error was dropped because it exceeded
+    the maximum output size.
+    """
+
+
+SSHShellMode = Literal['login', 'interactive', 'none']
+"""
+Shell used to run a command through SSH: a Bash login shell, a Bash interactive shell, which reads
+the user configuration files, or no shell besides the one used by the SSH server.
+"""
+
 
-def exec_ssh_shell_command(ssh_client: SSHClient, command: str) -> SSHCommandResult:
+class SSHSessionPool:
     """
-    Execute a shell command on a remote server through SSH.
+    A thread-safe pool of SSH sessions, each made of an SSH connection and an SFTP channel, which
+    are kept alive and reused across calls. The functions of this module accept a pool in place of
+    an SSH client, in which case they borrow a session from the pool instead of opening a new SFTP
+    channel for each call.
+
+    Sessions are created lazily using the `connect` function, which must return a new connected
+    SSH client, up to `max_sessions` sessions. Borrowers wait for an idle session once that limit
+    is reached. Sessions that have been idle for more than `health_check_interval` seconds are
+    checked before being borrowed, and dead sessions are reconnected.
     """
 
-    try:
-        _, stdout, stderr = ssh_client.exec_command(f'bash -ic {shlex.quote(command)}', get_pty=True)
+    def __init__(
+        self,
+        connect: Callable[[], SSHClient],
+        max_sessions: int = 4,
+        health_check_interval: float = 30.0,
+    ):
+        if max_sessions < 1:
+            raise ValueError(f"Invalid maximum number of SSH sessions {max_sessions}.")
 
-        # Wait until the command is completed and get the exit code.
-        exit_code = stdout.channel.recv_exit_status()
+        self.max_sessions = max_sessions
+        self._connect = connect
+        self._health_check_interval = health_check_interval
+        self._idle_sessions: list[_SSHSession] = []
+        self._sessions_count = 0
+        self._closed = False
+        self._condition = threading.Condition()
 
-        stdout_text = stdout.read().decode('utf-8')
-        stderr_text = stderr.read().decode('utf-8')
+    def __enter__(self) -> 'SSHSessionPool':
+        return self
 
-        stdout.close()
-        stderr.close()
-    except Exception as e:
-        print_error_exit(f"Error executing command '{command}'. Full error:\n{e}")
+    def __exit__(self, *_: object):
+        self.close()
+
+    @contextmanager
+    def sftp(self) -> Generator[SFTPClient, None, None]:
+        """
+        Borrow the SFTP channel of a session of the pool.
+        """
+
+        with self._borrow() as session:
+            yield session.sftp_client
+
+    @contextmanager
+    def ssh(self) -> Generator[SSHClient, None, None]:
+        """
+        Borrow the SSH client of a session of the pool, for instance to execute commands.
+        """
+
+        with self._borrow() as session:
+            yield session.ssh_client
+
+    def close(self):
+        """
+        Close the idle sessions of the pool, and the borrowed sessions once they are returned.
+        """
+
+        with self._condition:
+            self._closed = True
+            sessions = self._idle_sessions
+            self._idle_sessions = []
+            self._sessions_count -= len(sessions)
+            self._condition.notify_all()
+
+        for session in sessions:
+            _close_ssh_session(session)
+
+    @contextmanager
+    def _borrow(self) -> Generator['_SSHSession', None, None]:
+        """
+        Borrow a session of the pool, returning it to the pool once done.
+        """
+
+        session = self._acquire()
+        try:
+            yield session
+        finally:
+            self._release(session)
+
+    def _acquire(self) -> '_SSHSession':
+        """
+        Take an idle session of the pool if it is still usable, or open a new session if the pool
+        is not full, waiting for a session to be released otherwise.
+        """
+
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The SSH session pool is closed.")
+
+                if self._idle_sessions:
+                    session = self._idle_sessions.pop()
+                    break
+
+                if self._sessions_count < self.max_sessions:
+                    self._sessions_count += 1
+                    session = None
+                    break
+
+                self._condition.wait()
+
+        if session is not None:
+            if self._check_session(session):
+                return session
+
+            _close_ssh_session(session)
+
+        try:
+            return self._open_session()
+        except BaseException:
+            with self._condition:
+                self._sessions_count -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, session: '_SSHSession'):
+        """
+        Return a session to the pool, closing it if it is dead or if the pool is closed.
+        """
+
+        session.last_used = time.monotonic()
+        is_alive = _is_ssh_session_alive(session)
+        with self._condition:
+            if is_alive and not self._closed:
+                self._idle_sessions.append(session)
+            else:
+                self._sessions_count -= 1
+
+            self._condition.notify()
+
+        if not is_alive or self._closed:
+            _close_ssh_session(session)
+
+    def _open_session(self) -> '_SSHSession':
+        """
+        Open a new SSH connection and its SFTP channel.
+        """
+
+        ssh_client = self._connect()
+        try:
+            sftp_client = ssh_client.open_sftp()
+        except BaseException:
+            ssh_client.close()
+            raise
+
+        return _SSHSession(ssh_client, sftp_client, time.monotonic())
+
+    def _check_session(self, session: '_SSHSession') -> bool:
+        """
+        Check whether an idle session is still usable, doing a round trip only if it has not been
+        used recently.
+        """
+
+        if not _is_ssh_session_alive(session):
+            return False
+
+        if time.monotonic() - session.last_used < self._health_check_interval:
+            return True
+
+        # Do a round trip to detect connections silently dropped by the network.
+        try:
+            session.sftp_client.normalize('.')
+            return True
+        except (OSError, EOFError, SSHException):
+            return False
+
+
+def exec_ssh_command(
+    ssh_client: SSHClient | SSHSessionPool,
+    command: str,
+    shell: SSHShellMode = 'none',
+    pty: bool = False,
+    stdout_callback: Callable[[bytes], None] | None = None,
+    stderr_callback: Callable[[bytes], None] | None = None,
+    timeout: float | None = None,
+    max_output_size: int | None = 1024 * 1024,
+) -> SSHCommandResult:
+    """
+    Execute a command on a remote server through SSH, streaming its standard output and standard
+    error to the callbacks as they are received. The callbacks are never called concurrently.
+
+    The standard output and standard error of the result are limited to their last
+    `max_output_size` bytes, so that commands with large outputs can be processed by the
+    callbacks without being kept in memory. The standard error is merged into the standard output
+    if a pseudo-terminal is requested.
+
+    If a timeout is provided, the command is run by `timeout` on the remote server, which kills the
+    command and its subprocesses once the timeout expires, and a `TimeoutError` is raised.
+    """
+
+    match shell:
+        case 'none':
+            remote_command = command if timeout is None else f'sh -c {shlex.quote(command)}'
+        case 'login':
+            remote_command = f'bash -lc {shlex.quote(command)}'
+        case 'interactive':
+            remote_command = f'bash -ic {shlex.quote(command)}'
+
+    if timeout is not None:
+        remote_command = f'timeout --kill-after={_REMOTE_KILL_DELAY} {timeout} {remote_command}'
+
+    stdout_buffer = _OutputBuffer(max_output_size)
+    stderr_buffer = _OutputBuffer(max_output_size)
+    callback_lock = threading.Lock()
+
+    def read_output(
+        recv: Callable[[int], bytes],
+        buffer: '_OutputBuffer',
+        callback: Callable[[bytes], None] | None,
+    ):
+        while data := recv(_SSH_OUTPUT_CHUNK_SIZE):
+            buffer.add(data)
+            if callback is not None:
+                with callback_lock:
+                    callback(data)
+
+    with _borrow_ssh_client(ssh_client) as borrowed_ssh_client:
+        start_time = time.monotonic()
+        stdin, stdout, _ = borrowed_ssh_client.exec_command(remote_command, get_pty=pty)
+        stdin.close()
+
+        channel = stdout.channel
+        readers = [
+            threading.Thread(target=read_output, args=(channel.recv, stdout_buffer, stdout_callback)),
+            threading.Thread(target=read_output, args=(channel.recv_stderr, stderr_buffer, stderr_callback)),
+        ]
+
+        for reader in readers:
+            reader.start()
+
+        # Only give up on the channel if the remote `timeout` itself fails to end the command.
+        local_timeout = timeout + _REMOTE_KILL_DELAY + _LOCAL_TIMEOUT_DELAY if timeout is not None else None
+        if not channel.status_event.wait(local_timeout):
+            channel.close()
+
+        for reader in readers:
+            reader.join()
+
+        if not channel.exit_status_ready():
+            raise TimeoutError(f"Command '{command}' did not complete after {timeout} seconds.")
+
+        exit_code = channel.recv_exit_status()
+        elapsed_time = time.monotonic() - start_time
+
+    # Exit code of `timeout` if the command timed out, or if it was killed after the kill delay.
+    # The command can also exit with these codes by itself, or be killed by another process such as
+    # the OOM killer, before the timeout expires.
+    if timeout is not None and exit_code in (124, 128 + 9) and elapsed_time >= timeout:
+        raise TimeoutError(f"Command '{command}' did not complete after {timeout} seconds.")
 
     return SSHCommandResult(
         exit_code = exit_code,
-        stdout    = stdout_text,
-        stderr    = stderr_text,
+        stdout    = stdout_buffer.get_text(),
+        stderr    = stderr_buffer.get_text(),
+        truncated = stdout_buffer.truncated or stderr_buffer.truncated,
     )
 
 
-def check_ssh_path_exists(ssh_client: SSHClient, remote_path: str) -> bool:
+def exec_ssh_shell_command(ssh_client: SSHClient | SSHSessionPool, command: str) -> SSHCommandResult:
     """
-    Check whether a file or directory exists on a remote server using SFTP.
+    Execute a shell command on a remote server through SSH, using an interactive Bash shell with a
+    pseudo-terminal, and keeping the whole output in memory.
     """
 
-    sftp_client = ssh_client.open_sftp()
-
     try:
-        sftp_client.stat(remote_path)
-        return True
-    except FileNotFoundError:
-        return False
-    finally:
-        sftp_client.close()
+        return exec_ssh_command(ssh_client, command, shell='interactive', pty=True, max_output_size=None)
+    except Exception as e:
+        print_error_exit(f"Error executing command '{command}'. Full error:\n{e}")
 
 
-def delete_ssh_file(ssh_client: SSHClient, remote_file_path: str):
+def check_ssh_path_exists(ssh_client: SSHClient | SSHSessionPool, remote_path: str) -> bool:
+    """
+    Check whether a file or directory exists on a remote server using SFTP.
+    """
+
+    with _open_sftp(ssh_client) as sftp_client:
+        try:
+            sftp_client.stat(remote_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def delete_ssh_file(ssh_client: SSHClient | SSHSessionPool, remote_file_path: str):
     """
     Delete a file or directory on a remote server using SFTP.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
+    with _open_sftp(ssh_client) as sftp_client:
         sftp_client.remove(remote_file_path)
-    finally:
-        sftp_client.close()
 
 
-def delete_ssh_file_rec(ssh_client: SSHClient, remote_dir_path: str):
+def delete_ssh_file_rec(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_dir_path: str,
+    progress_callback: Callable[[str], None] | None = None,
+    workers: int | None = None,
+    quiet: bool = False,
+    shell_command: bool = False,
+):
     """
-    Delete a directory on a remote server using SFTP.
+    Delete a directory on a remote server, calling the progress callback with the relative path of
+    each file being deleted. The name of each file being deleted is printed if no progress callback
+    is provided and `quiet` is not set.
+
+    If `shell_command` is set, the directory is deleted by a single `rm -rf` command on the remote
+    server, and using SFTP only if that command fails. Using SFTP, each remote directory is listed
+    once along with the attributes of its entries, then the files are deleted concurrently over
+    `workers` SFTP channels, followed by the directories deepest first. Symbolic links are deleted
+    and not followed. The root directory, the home directory, and the paths that contain `..` are
+    never deleted.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
-        _delete_ssh_file_rec_impl(sftp_client, remote_dir_path, '')
-    finally:
-        sftp_client.close()
+    normalized_remote_dir_path = os.path.normpath(remote_dir_path)
+    if normalized_remote_dir_path.strip('/') in ('', '.') or '..' in normalized_remote_dir_path.split('/'):
+        raise ValueError(f"Refusing to delete the remote path '{remote_dir_path}'.")
+
+    # Relative paths are relative to the home directory, which can also be given as an absolute path.
+    with _open_sftp(ssh_client) as sftp_client:
+        home_dir_path = os.path.normpath(sftp_client.normalize('.'))
+
+    if normalized_remote_dir_path == home_dir_path:
+        raise ValueError(f"Refusing to delete the remote home directory '{remote_dir_path}'.")
+
+    if shell_command:
+        result = exec_ssh_command(ssh_client, f'rm -rf -- {shlex.quote(normalized_remote_dir_path)}')
+        if result.exit_code == 0:
+            return
+
+        print_warning(
+            f"Cannot delete '{remote_dir_path}' using 'rm -rf', deleting it using SFTP instead. Full error:\n"
+            f"{result.stderr}"
+        )
 
+    def print_progress(file_rel_path: str):
+        print(f'Deleting file \'{file_rel_path}\'...')
 
-def upload_ssh_file(ssh_client: SSHClient, local_file_path: str, remote_file_path: str):
+    if progress_callback is None and not quiet:
+        progress_callback = print_progress
+
+    dir_rel_paths, files = _list_ssh_file_rec(ssh_client, remote_dir_path, '', workers, follow_symlinks=False)
+
+    progress = _TransferProgress(progress_callback, None)
+
+    def delete_file(sftp_client: SFTPClient, file: DirSnapshotFile):
+        progress.report_file(file.path)
+        try:
+            sftp_client.remove(os.path.normpath(os.path.join(remote_dir_path, file.path)))
+        except Exception as error:
+            error.add_note(f"Cannot delete file '{file.path}'.")
+            raise
+
+    def delete_dir(sftp_client: SFTPClient, dir_rel_path: str):
+        try:
+            sftp_client.rmdir(os.path.normpath(os.path.join(remote_dir_path, dir_rel_path)))
+        except Exception as error:
+            error.add_note(f"Cannot delete directory '{dir_rel_path}'.")
+            raise
+
+    errors = _run_sftp_workers(ssh_client, workers, files, delete_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot delete {len(errors)} files of '{remote_dir_path}'.", errors)
+
+    # Delete the directories of a same depth concurrently, starting with the deepest ones.
+    depth_dir_rel_paths: dict[int, list[str]] = {}
+    for dir_rel_path in dir_rel_paths:
+        depth = dir_rel_path.count('/') + 1 if dir_rel_path else 0
+        depth_dir_rel_paths.setdefault(depth, []).append(dir_rel_path)
+
+    for depth in sorted(depth_dir_rel_paths, reverse=True):
+        errors = _run_sftp_workers(ssh_client, workers, depth_dir_rel_paths[depth], delete_dir)
+        if errors:
+            raise ExceptionGroup(f"Cannot delete {len(errors)} directories of '{remote_dir_path}'.", errors)
+
+
+def get_ssh_directory_usage(ssh_client: SSHClient | SSHSessionPool, remote_dir_path: str) -> DiskUsage:
+    """
+    Get the disk usage of the files of a remote directory recursively using a single `find`
+    command on the remote server, which avoids traversing the directory using SFTP.
+
+    Symbolic links are not followed, and the files with several hard links are only counted once.
+    The sizes of the directories themselves are not counted.
+    """
+
+    pipeline = (
+        f'set -o pipefail; find {shlex.quote(remote_dir_path)} ! -type d -printf {_FIND_USAGE_FORMAT} '
+        f'| awk {_AWK_USAGE_PROGRAM}'
+    )
+
+    result = exec_ssh_command(ssh_client, f'bash -c {shlex.quote(pipeline)}')
+    if result.exit_code != 0:
+        raise Exception(f"Cannot get the disk usage of '{remote_dir_path}'. Full error:\n{result.stderr}")
+
+    apparent_size, allocated_size, file_count = result.stdout.split()
+    return DiskUsage(int(apparent_size), int(allocated_size), int(file_count))
+
+
+def upload_ssh_file(ssh_client: SSHClient | SSHSessionPool, local_file_path: str, remote_file_path: str):
     """
     Upload a local file to a remote server using SFTP.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
+    with _open_sftp(ssh_client) as sftp_client:
         sftp_client.put(local_file_path, remote_file_path)
-    finally:
-        sftp_client.close()
 
 
 def upload_ssh_directory(
-    ssh_client: SSHClient,
+    ssh_client: SSHClient | SSHSessionPool,
     local_dir_path: str,
     remote_dir_path: str,
     progress_callback: Callable[[str], None] | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+    workers: int | None = None,
 ):
     """
-    Upload a local directory to a remote server using SFTP. Printing the name of each file being
-    uploaded.
+    Upload a local directory to a remote server using SFTP, calling the progress callback with the
+    relative path of each file being uploaded, and the size progress callback with the number of
+    bytes uploaded.
+
+    The remote directories are created first, then the files are uploaded concurrently over
+    `workers` SFTP channels, which defaults to the size of the pool for an SSH session pool, and to
+    a single channel for an SSH client. The callbacks are never called concurrently. The errors of
+    the files that cannot be uploaded are raised together once all the other files are uploaded.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
-        for root_dir_path, _, file_names in os.walk(local_dir_path):
-            sub_dir_rel_path = os.path.normpath(os.path.relpath(root_dir_path, local_dir_path))
-            remote_sub_dir_path = os.path.normpath(os.path.join(remote_dir_path, sub_dir_rel_path))
-
-            sftp_client.mkdir(remote_sub_dir_path)
-
-            for file_name in file_names:
-                file_rel_path = os.path.join(sub_dir_rel_path, file_name)
-                local_file_path = os.path.join(local_dir_path, file_rel_path)
-                remote_file_path = os.path.join(remote_dir_path, file_rel_path)
-                if progress_callback is not None:
-                    progress_callback(file_rel_path)
-                sftp_client.put(local_file_path, remote_file_path)
-    finally:
-        sftp_client.close()
+    snapshot = scan_dir(local_dir_path)
+
+    with _open_sftp(ssh_client) as sftp_client:
+        for dir_rel_path in snapshot.dir_paths:
+            sftp_client.mkdir(os.path.normpath(os.path.join(remote_dir_path, dir_rel_path)))
+
+    progress = _TransferProgress(progress_callback, progress_size_callback)
+
+    def upload_file(sftp_client: SFTPClient, file: DirSnapshotFile):
+        progress.report_file(file.path)
+        try:
+            _put_ssh_file(
+                sftp_client,
+                os.path.join(local_dir_path, file.path),
+                os.path.join(remote_dir_path, file.path),
+                progress.report_size,
+            )
+        except Exception as error:
+            error.add_note(f"Cannot upload file '{file.path}'.")
+            raise
+
+    errors = _run_sftp_workers(ssh_client, workers, snapshot.files, upload_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot upload {len(errors)} files to '{remote_dir_path}'.", errors)
+
+
+def sync_ssh_directory_upload(
+    ssh_client: SSHClient | SSHSessionPool,
+    local_dir_path: str,
+    remote_dir_path: str,
+    progress_callback: Callable[[str], None] | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+    workers: int | None = None,
+    hash_content: bool = False,
+):
+    """
+    Incrementally update a remote copy of a local directory created by `upload_ssh_directory` or
+    by a previous call of this function, which can also be interrupted and called again.
+
+    Only the files that are missing or whose size or modification time differ on the remote server
+    are uploaded, and the modification time of the uploaded files is preserved. Files are uploaded
+    to a partial file that is renamed once complete, and whose name contains the size and the
+    modification time of the local file. The partial files left by an interrupted upload are
+    resumed from their size if their local file did not change since, and are deleted otherwise.
+    If `hash_content` is set, the files of the same size whose modification time differs are
+    compared using `sha256sum` on the remote server, and only their modification time is updated
+    if their content is the same. The remote files that do not exist locally are kept.
+    """
+
+    snapshot = scan_dir(local_dir_path)
+    remote_dir_rel_paths, remote_files = _list_ssh_dir_rec_if_exists(ssh_client, remote_dir_path, workers)
+
+    with _open_sftp(ssh_client) as sftp_client:
+        for dir_rel_path in snapshot.dir_paths:
+            if dir_rel_path not in remote_dir_rel_paths:
+                sftp_client.mkdir(os.path.normpath(os.path.join(remote_dir_path, dir_rel_path)))
+
+    transfers, same_size_files, stale_partial_file_rel_paths = _plan_ssh_sync(
+        snapshot.files,
+        remote_files,
+        hash_content,
+    )
+
+    def delete_partial_file(sftp_client: SFTPClient, partial_file_rel_path: str):
+        sftp_client.remove(os.path.join(remote_dir_path, partial_file_rel_path))
+
+    errors = _run_sftp_workers(ssh_client, workers, stale_partial_file_rel_paths, delete_partial_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot delete {len(errors)} partial files of '{remote_dir_path}'.", errors)
+
+    if same_size_files:
+        remote_sha256s = _get_ssh_sha256s(ssh_client, remote_dir_path, [file.path for file in same_size_files])
+        same_files, changed_files = _compare_sha256s(local_dir_path, same_size_files, remote_sha256s)
+        transfers.extend((file, 0) for file in changed_files)
+
+        def touch_file(sftp_client: SFTPClient, file: DirSnapshotFile):
+            mtime = file.mtime_ns / _NS_PER_SECOND
+            sftp_client.utime(os.path.join(remote_dir_path, file.path), (mtime, mtime))
+
+        errors = _run_sftp_workers(ssh_client, workers, same_files, touch_file)
+        if errors:
+            raise ExceptionGroup(f"Cannot update {len(errors)} files of '{remote_dir_path}'.", errors)
 
+    progress = _TransferProgress(progress_callback, progress_size_callback)
 
-def download_ssh_file(ssh_client: SSHClient, remote_file_path: str, local_file_path: str):
+    def upload_file(sftp_client: SFTPClient, transfer: tuple[DirSnapshotFile, int]):
+        file, offset = transfer
+        progress.report_file(file.path)
+        try:
+            remote_file_path = os.path.join(remote_dir_path, file.path)
+            partial_file_path = os.path.join(remote_dir_path, _get_partial_file_rel_path(file))
+            progress.report_size(offset)
+            _put_ssh_file(
+                sftp_client,
+                os.path.join(local_dir_path, file.path),
+                partial_file_path,
+                progress.report_size,
+                offset,
+            )
+
+            mtime = file.mtime_ns / _NS_PER_SECOND
+            sftp_client.utime(partial_file_path, (mtime, mtime))
+            sftp_client.posix_rename(partial_file_path, remote_file_path)
+        except Exception as error:
+            error.add_note(f"Cannot upload file '{file.path}'.")
+            raise
+
+    transfers.sort(key=lambda transfer: transfer[0].path)
+    errors = _run_sftp_workers(ssh_client, workers, transfers, upload_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot upload {len(errors)} files to '{remote_dir_path}'.", errors)
+
+
+def download_ssh_file(ssh_client: SSHClient | SSHSessionPool, remote_file_path: str, local_file_path: str):
     """
     Download a remote file using SFTP.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
+    with _open_sftp(ssh_client) as sftp_client:
         sftp_client.get(remote_file_path, local_file_path)
-    finally:
-        sftp_client.close()
 
 
-def download_ssh_file_rec(ssh_client: SSHClient, remote_root_path: str, local_root_path: str, rel_path: str):
+def download_ssh_file_rec(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_root_path: str,
+    local_root_path: str,
+    rel_path: str,
+    progress_callback: Callable[[str], None] | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+    workers: int | None = None,
+    quiet: bool = False,
+):
     """
-    Download a remote file or directory using SFTP, recursively traversing directories and printing
-    the name of each file being downloaded.
+    Download a remote file or directory using SFTP, recursively traversing directories, calling
+    the progress callback with the relative path of each file being downloaded, and the size
+    progress callback with the number of bytes downloaded. The name of each file being downloaded
+    is printed if no progress callback is provided and `quiet` is not set.
+
+    Each remote directory is listed once along with the attributes of its entries, the directories
+    of a same depth being listed concurrently, then the files are downloaded concurrently over
+    `workers` SFTP channels using prefetched reads. The callbacks are never called concurrently.
+    The errors of the files that cannot be downloaded are raised together once all the other files
+    are downloaded.
     """
 
-    sftp_client = ssh_client.open_sftp()
-    try:
-        _download_ssh_file_rec_impl(sftp_client, remote_root_path, local_root_path, rel_path)
-    finally:
-        sftp_client.close()
+    def print_progress(file_rel_path: str):
+        print(f'Downloading file \'{file_rel_path}\'...')
+
+    if progress_callback is None and not quiet:
+        progress_callback = print_progress
 
+    dir_rel_paths, files = _list_ssh_file_rec(ssh_client, remote_root_path, rel_path, workers)
 
-def _delete_ssh_file_rec_impl(sftp_client: SFTPClient, remote_root_path: str, rel_path: str):
+    for dir_rel_path in dir_rel_paths:
+        os.makedirs(os.path.join(local_root_path, dir_rel_path), exist_ok=True)
+
+    progress = _TransferProgress(progress_callback, progress_size_callback)
+
+    def download_file(sftp_client: SFTPClient, file: DirSnapshotFile):
+        progress.report_file(file.path)
+        try:
+            _get_ssh_file(
+                sftp_client,
+                os.path.join(remote_root_path, file.path),
+                os.path.join(local_root_path, file.path),
+                file.size,
+                progress.report_size,
+            )
+        except Exception as error:
+            error.add_note(f"Cannot download file '{file.path}'.")
+            raise
+
+    errors = _run_sftp_workers(ssh_client, workers, files, download_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot download {len(errors)} files from '{remote_root_path}'.", errors)
+
+
+def sync_ssh_directory_download(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_dir_path: str,
+    local_dir_path: str,
+    progress_callback: Callable[[str], None] | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+    workers: int | None = None,
+    hash_content: bool = False,
+):
     """
-    Utiliy function for `delete_ssh_file_rec`.
+    Incrementally update a local copy of a remote directory created by `download_ssh_file_rec` or
+    by a previous call of this function, which can also be interrupted and called again.
+
+    This function is the download counterpart of `sync_ssh_directory_upload`, and compares,
+    resumes, and preserves the modification time of the files in the same way.
     """
 
-    full_remote_path = os.path.join(remote_root_path, rel_path)
+    remote_dir_rel_paths, remote_files = _list_ssh_file_rec(ssh_client, remote_dir_path, '', workers)
+    local_files = scan_dir(local_dir_path).files if os.path.isdir(local_dir_path) else []
 
-    item_attr = sftp_client.stat(full_remote_path)
-    if item_attr.st_mode is None:
-        raise Exception(f'ST mode not available for item \'{rel_path}\'.')
+    for dir_rel_path in remote_dir_rel_paths:
+        os.makedirs(os.path.join(local_dir_path, dir_rel_path), exist_ok=True)
 
-    if stat.S_ISDIR(item_attr.st_mode):
-        for file_name in sftp_client.listdir(full_remote_path):
-            sub_rel_path = os.path.join(rel_path, file_name)
-            _delete_ssh_file_rec_impl(sftp_client, remote_root_path, sub_rel_path)
+    transfers, same_size_files, stale_partial_file_rel_paths = _plan_ssh_sync(
+        remote_files,
+        local_files,
+        hash_content,
+    )
 
-        sftp_client.rmdir(full_remote_path)
-    else:
-        print(f'Deleting file \'{rel_path}\'...')
-        sftp_client.remove(full_remote_path)
+    for partial_file_rel_path in stale_partial_file_rel_paths:
+        os.remove(os.path.join(local_dir_path, partial_file_rel_path))
+
+    if same_size_files:
+        remote_sha256s = _get_ssh_sha256s(ssh_client, remote_dir_path, [file.path for file in same_size_files])
+        same_files, changed_files = _compare_sha256s(local_dir_path, same_size_files, remote_sha256s)
+        transfers.extend((file, 0) for file in changed_files)
+        for file in same_files:
+            os.utime(os.path.join(local_dir_path, file.path), ns=(file.mtime_ns, file.mtime_ns))
+
+    progress = _TransferProgress(progress_callback, progress_size_callback)
 
+    def download_file(sftp_client: SFTPClient, transfer: tuple[DirSnapshotFile, int]):
+        file, offset = transfer
+        progress.report_file(file.path)
+        try:
+            partial_file_path = os.path.join(local_dir_path, _get_partial_file_rel_path(file))
+            progress.report_size(offset)
+            _get_ssh_file(
+                sftp_client,
+                os.path.join(remote_dir_path, file.path),
+                partial_file_path,
+                file.size,
+                progress.report_size,
+                offset,
+            )
 
-def _download_ssh_file_rec_impl(sftp_client: SFTPClient, remote_root_path: str, local_root_path: str, rel_path: str):
+            os.utime(partial_file_path, ns=(file.mtime_ns, file.mtime_ns))
+            os.replace(partial_file_path, os.path.join(local_dir_path, file.path))
+        except Exception as error:
+            error.add_note(f"Cannot download file '{file.path}'.")
+            raise
+
+    transfers.sort(key=lambda transfer: transfer[0].path)
+    errors = _run_sftp_workers(ssh_client, workers, transfers, download_file)
+    if errors:
+        raise ExceptionGroup(f"Cannot download {len(errors)} files from '{remote_dir_path}'.", errors)
+
+
+def upload_ssh_directory_tar(
+    ssh_client: SSHClient | SSHSessionPool,
+    local_dir_path: str,
+    remote_dir_path: str,
+    compression: TarCompression | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+    workers: int = 8,
+):
+    """
+    Upload a local directory to a remote server as a single tar stream written to the standard
+    input of `tar` on the remote server, which avoids the per-file round trips of SFTP for
+    directories that contain many small files. The remote directory is created if needed.
+
+    If a compression format is provided, the tar stream is compressed in parallel using a pool of
+    `workers` threads, and decompressed by the remote `tar`. Progress is printed, or the size
+    progress callback is called with the size of each uploaded file if one is provided. An
+    exception is raised if the remote `tar` fails.
+    """
+
+    remote_dir_path = shlex.quote(remote_dir_path)
+    command = f'mkdir -p {remote_dir_path} && tar -x {_get_tar_compression_flag(compression)} -C {remote_dir_path}'
+    with _borrow_ssh_client(ssh_client) as borrowed_ssh_client:
+        stdin, stdout, stderr = borrowed_ssh_client.exec_command(command)
+        try:
+            tar_with_progress(local_dir_path, cast(BinaryIO, stdin), '.', compression, workers, progress_size_callback)
+        except BaseException as error:
+            # Close the standard input of the remote command whatever the error is, so that it does
+            # not wait for more data, without flushing the buffered data as the channel may be
+            # closed. The channel is closed if the remote command failed first, in which case its
+            # error is the most relevant.
+            stdin.channel.shutdown_write()
+            if isinstance(error, OSError) and stdout.channel.exit_status_ready():
+                _check_ssh_tar_exit_status(stdout.channel, stderr)
+            raise
+
+        stdin.close()
+        _check_ssh_tar_exit_status(stdout.channel, stderr)
+
+
+def download_ssh_directory_tar(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_dir_path: str,
+    local_dir_path: str,
+    compression: TarCompression | None = None,
+    progress_size_callback: Callable[[int], None] | None = None,
+):
+    """
+    Download a remote directory as a single tar stream read from the standard output of `tar` on
+    the remote server, which avoids the per-file round trips of SFTP for directories that contain
+    many small files. The local directory is created if needed.
+
+    If a compression format is provided, the tar stream is compressed by the remote `tar`. The size
+    progress callback is called with the size of each downloaded file if one is provided. An
+    exception is raised if the remote `tar` fails.
+    """
+
+    os.makedirs(local_dir_path, exist_ok=True)
+
+    command = f'tar -c {_get_tar_compression_flag(compression)} -C {shlex.quote(remote_dir_path)} .'
+    with _borrow_ssh_client(ssh_client) as borrowed_ssh_client:
+        stdin, stdout, stderr = borrowed_ssh_client.exec_command(command)
+        stdin.close()
+        try:
+            extract_tar_stream(cast(BinaryIO, stdout), local_dir_path, compression, progress_size_callback)
+        except (OSError, tarfile.TarError):
+            # Close the channel so that the remote command does not wait for its output to be read,
+            # and raise its error instead if it failed first. Closing the channel marks its exit
+            # status as ready, so whether the command ended is checked beforehand.
+            has_exited = stdout.channel.exit_status_ready()
+            stdout.channel.close()
+            if has_exited:
+                _check_ssh_tar_exit_status(stdout.channel, stderr)
+            raise
+
+        # Read the padding that may follow the end of the archive.
+        stdout.read()
+        _check_ssh_tar_exit_status(stdout.channel, stderr)
+
+
+_SSH_OUTPUT_CHUNK_SIZE = 64 * 1024
+
+# Delay in seconds after which the remote `timeout` kills a command that ignores its termination.
+_REMOTE_KILL_DELAY = 10
+
+# Additional delay in seconds after which a timed out command that did not end is abandoned.
+_LOCAL_TIMEOUT_DELAY = 10
+
+_SFTP_CHUNK_SIZE = 1024 * 1024
+
+_NS_PER_SECOND = 1_000_000_000
+
+_PARTIAL_FILE_NAME_REGEX = re.compile(r'^\..+\.\d+-\d+\.part$')
+
+# Number of hard links, device and inode, size, and number of 512 bytes blocks of a file.
+_FIND_USAGE_FORMAT = shlex.quote('%n %D:%i %s %b\\n')
+
+# Sum the sizes of the files, counting the files with several hard links only once.
+_AWK_USAGE_PROGRAM = shlex.quote(
+    '$1 == 1 || !seen[$2]++ { size += $3; blocks += $4; count += 1 } '
+    'END { printf "%.0f %.0f %.0f\\n", size, blocks * 512, count }'
+)
+
+
+class _OutputBuffer:
+    """
+    The output of a command, which retains only the last bytes of that output if a maximum size is
+    provided.
+    """
+
+    def __init__(self, max_size: int | None):
+        self.truncated = False
+        self._max_size = max_size
+        self._data = bytearray()
+
+    def add(self, data: bytes):
+        """
+        Add data to the output, dropping its oldest bytes if the maximum size is exceeded.
+        """
+
+        self._data += data
+        if self._max_size is not None and len(self._data) > self._max_size:
+            del self._data[:len(self._data) - self._max_size]
+            self.truncated = True
+
+    def get_text(self) -> str:
+        """
+        Get the retained output decoded as UTF-8 text.
+        """
+
+        # The retained output may start in the middle of a multi-byte character.
+        return self._data.decode('utf-8', errors='replace')
+
+
+class _TransferProgress:
+    """
+    The progress callbacks of a transfer, which are called under a lock as the files of the
+    transfer are transferred by several threads.
+    """
+
+    def __init__(self, file_callback: Callable[[str], None] | None, size_callback: Callable[[int], None] | None):
+        self._file_callback = file_callback
+        self._size_callback = size_callback
+        self._lock = threading.Lock()
+
+    def report_file(self, file_rel_path: str):
+        """
+        Report that a file starts being transferred.
+        """
+
+        if self._file_callback is not None:
+            with self._lock:
+                self._file_callback(file_rel_path)
+
+    def report_size(self, size: int):
+        """
+        Report a number of bytes transferred.
+        """
+
+        if self._size_callback is not None and size > 0:
+            with self._lock:
+                self._size_callback(size)
+
+
+def _put_ssh_file(
+    sftp_client: SFTPClient,
+    local_file_path: str,
+    remote_file_path: str,
+    size_callback: Callable[[int], None],
+    offset: int = 0,
+):
+    """
+    Upload a local file using large pipelined SFTP writes, which do not wait for the server to
+    acknowledge each write before sending the next one. If an offset is provided, the upload
+    resumes a partial remote file of that size.
+    """
+
+    with open(local_file_path, 'rb') as local_file, \
+            sftp_client.open(remote_file_path, 'r+b' if offset > 0 else 'wb') as remote_file:
+        local_file.seek(offset)
+        remote_file.seek(offset)
+        remote_file.set_pipelined(True)
+        while data := local_file.read(_SFTP_CHUNK_SIZE):
+            remote_file.write(data)
+            size_callback(len(data))
+
+
+def _run_sftp_workers(
+    ssh_client: SSHClient | SSHSessionPool,
+    workers: int | None,
+    items: list[T],
+    function: Callable[[SFTPClient, T], None],
+) -> list[Exception]:
+    """
+    Process items concurrently using one thread per SFTP channel, each channel being borrowed from
+    the pool or opened on the SSH client for the whole run, and return the errors raised for the
+    individual items.
+    """
+
+    if isinstance(ssh_client, SSHSessionPool):
+        workers = min(workers, ssh_client.max_sessions) if workers is not None else ssh_client.max_sessions
+    elif workers is None:
+        workers = 1
+
+    items_iterator = iter(items)
+    lock = threading.Lock()
+    errors: list[Exception] = []
+
+    def run_worker():
+        with _open_sftp(ssh_client) as sftp_client:
+            while True:
+                with lock:
+                    item = next(items_iterator, None)
+
+                if item is None:
+                    return
+
+                try:
+                    function(sftp_client, item)
+                except Exception as error:
+                    with lock:
+                        errors.append(error)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_worker) for _ in range(min(workers, len(items)))]
+        for future in futures:
+            future.result()
+
+    return errors
+
+
+def _get_ssh_file(
+    sftp_client: SFTPClient,
+    remote_file_path: str,
+    local_file_path: str,
+    remote_file_size: int,
+    size_callback: Callable[[int], None],
+    offset: int = 0,
+):
     """
-    Utiliy function for `download_ssh_file_rec`.
+    Download a remote file of a known size, requesting all its blocks ahead of reading them
+    instead of waiting for the server to answer each read. If an offset is provided, the download
+    resumes a partial local file of that size.
     """
 
-    full_remote_path = os.path.join(remote_root_path, rel_path)
-    full_local_path = os.path.join(local_root_path, rel_path)
+    with sftp_client.open(remote_file_path, 'rb') as remote_file, \
+            open(local_file_path, 'r+b' if offset > 0 else 'wb') as local_file:
+        remote_file.seek(offset)
+        local_file.seek(offset)
+        if remote_file_size > offset:
+            remote_file.prefetch(remote_file_size)
+
+        while data := remote_file.read(_SFTP_CHUNK_SIZE):
+            local_file.write(data)
+            size_callback(len(data))
+
+
+def _list_ssh_file_rec(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_root_path: str,
+    rel_path: str,
+    workers: int | None,
+    follow_symlinks: bool = True,
+) -> tuple[list[str], list[DirSnapshotFile]]:
+    """
+    List a remote file or directory recursively, listing the directories of a same depth
+    concurrently, and return the relative paths of the directories, sorted so that each directory
+    comes before its subdirectories, and the files, sorted by path. Symbolic links are followed,
+    unless `follow_symlinks` is unset in which case they are listed as files.
+    """
+
+    with _open_sftp(ssh_client) as sftp_client:
+        remote_path = os.path.join(remote_root_path, rel_path) if rel_path else remote_root_path
+        item_attr = sftp_client.stat(remote_path) if follow_symlinks else sftp_client.lstat(remote_path)
 
-    item_attr = sftp_client.stat(full_remote_path)
     if item_attr.st_mode is None:
         raise Exception(f'ST mode not available for item \'{rel_path}\'.')
 
-    if stat.S_ISDIR(item_attr.st_mode):
-        if not os.path.exists(full_local_path):
-            os.makedirs(full_local_path)
+    if not stat.S_ISDIR(item_attr.st_mode):
+        return [], [_get_remote_file(rel_path, item_attr)]
+
+    dir_rel_paths: list[str] = []
+    files: list[DirSnapshotFile] = []
+    sub_dir_rel_paths: list[str] = []
+    lock = threading.Lock()
+
+    def list_dir(sftp_client: SFTPClient, dir_rel_path: str):
+        for entry_attr in sftp_client.listdir_attr(os.path.join(remote_root_path, dir_rel_path)):
+            entry_rel_path = os.path.join(dir_rel_path, entry_attr.filename)
+            if follow_symlinks and entry_attr.st_mode is not None and stat.S_ISLNK(entry_attr.st_mode):
+                entry_attr = sftp_client.stat(os.path.join(remote_root_path, entry_rel_path))
+
+            if entry_attr.st_mode is None:
+                raise Exception(f'ST mode not available for item \'{entry_rel_path}\'.')
+
+            with lock:
+                if stat.S_ISDIR(entry_attr.st_mode):
+                    sub_dir_rel_paths.append(entry_rel_path)
+                else:
+                    files.append(_get_remote_file(entry_rel_path, entry_attr))
+
+    level_dir_rel_paths = [rel_path]
+    while level_dir_rel_paths:
+        dir_rel_paths.extend(level_dir_rel_paths)
+        errors = _run_sftp_workers(ssh_client, workers, level_dir_rel_paths, list_dir)
+        if errors:
+            raise ExceptionGroup(f"Cannot list {len(errors)} directories of '{remote_root_path}'.", errors)
+
+        level_dir_rel_paths = sorted(sub_dir_rel_paths)
+        sub_dir_rel_paths.clear()
+
+    files.sort(key=lambda file: file.path)
+    return dir_rel_paths, files
+
+
+def _list_ssh_dir_rec_if_exists(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_dir_path: str,
+    workers: int | None,
+) -> tuple[set[str], list[DirSnapshotFile]]:
+    """
+    List a remote directory recursively, or return no directories and no files if that directory
+    does not exist.
+    """
+
+    try:
+        dir_rel_paths, files = _list_ssh_file_rec(ssh_client, remote_dir_path, '', workers)
+    except FileNotFoundError:
+        return set(), []
+
+    return set(dir_rel_paths), files
+
+
+def _get_remote_file(rel_path: str, attr: SFTPAttributes) -> DirSnapshotFile:
+    """
+    Get the size and modification time of a remote file from its SFTP attributes, which only have
+    a precision of one second.
+    """
+
+    return DirSnapshotFile(rel_path, attr.st_size or 0, (attr.st_mtime or 0) * _NS_PER_SECOND)
+
+
+def _get_partial_file_rel_path(file: DirSnapshotFile) -> str:
+    """
+    Get the relative path of the partial file of a file being synchronized, whose name contains
+    the size and the modification time in seconds of the source file so that a partial file is
+    only resumed for the same version of that file.
+    """
+
+    dir_rel_path, file_name = os.path.split(file.path)
+    return os.path.join(dir_rel_path, f'.{file_name}.{file.size}-{file.mtime_ns // _NS_PER_SECOND}.part')
+
+
+def _plan_ssh_sync(
+    src_files: list[DirSnapshotFile],
+    dst_files: list[DirSnapshotFile],
+    hash_content: bool,
+) -> tuple[list[tuple[DirSnapshotFile, int]], list[DirSnapshotFile], list[str]]:
+    """
+    Compare the source and destination files of a synchronization, and return the source files to
+    transfer along with the offset from which to resume them, the source files of the same size as
+    their destination whose content must be compared if `hash_content` is set, and the destination
+    partial files that cannot be resumed. Modification times are compared with a precision of one
+    second.
+    """
+
+    dst_files_dict = {file.path: file for file in dst_files}
+    transfers: list[tuple[DirSnapshotFile, int]] = []
+    same_size_files: list[DirSnapshotFile] = []
+    resumable_partial_file_rel_paths: set[str] = set()
+
+    for file in src_files:
+        dst_file = dst_files_dict.get(file.path)
+        if dst_file is not None and dst_file.size == file.size:
+            if dst_file.mtime_ns // _NS_PER_SECOND == file.mtime_ns // _NS_PER_SECOND:
+                continue
+
+            if hash_content:
+                same_size_files.append(file)
+                continue
+
+        partial_file = dst_files_dict.get(_get_partial_file_rel_path(file))
+        if partial_file is not None and partial_file.size <= file.size:
+            resumable_partial_file_rel_paths.add(partial_file.path)
+            transfers.append((file, partial_file.size))
+        else:
+            transfers.append((file, 0))
+
+    # The other partial files were written for another version of their source file, or for a
+    # source file that was since deleted or completely transferred.
+    src_file_rel_paths = {file.path for file in src_files}
+    stale_partial_file_rel_paths = [
+        file.path for file in dst_files
+        if _PARTIAL_FILE_NAME_REGEX.match(os.path.basename(file.path))
+        and file.path not in resumable_partial_file_rel_paths
+        and file.path not in src_file_rel_paths
+    ]
+
+    return transfers, same_size_files, stale_partial_file_rel_paths
+
+
+def _get_ssh_sha256s(
+    ssh_client: SSHClient | SSHSessionPool,
+    remote_dir_path: str,
+    file_rel_paths: list[str],
+) -> dict[str, str]:
+    """
+    Get the SHA-256 hashes of remote files by running `sha256sum` on the remote server, in batches
+    of files that fit in a command line.
+    """
+
+    batches: list[list[str]] = []
+    batch_length = _MAX_COMMAND_LENGTH
+    for file_rel_path in file_rel_paths:
+        quoted_file_rel_path = shlex.quote(file_rel_path)
+        if batch_length + len(quoted_file_rel_path) >= _MAX_COMMAND_LENGTH:
+            batches.append([])
+            batch_length = 0
+
+        batches[-1].append(quoted_file_rel_path)
+        batch_length += len(quoted_file_rel_path) + 1
+
+    sha256s: dict[str, str] = {}
+    for batch in batches:
+        result = exec_ssh_command(
+            ssh_client,
+            f'cd {shlex.quote(remote_dir_path)} && sha256sum -z -- {" ".join(batch)}',
+            max_output_size=None,
+        )
+
+        if result.exit_code != 0:
+            raise Exception(f"Cannot hash remote files in '{remote_dir_path}'. Full error:\n{result.stderr}")
+
+        # Each entry is the hexadecimal hash, two separator characters, and the file path.
+        for entry in result.stdout.split('\0'):
+            if entry:
+                sha256s[entry[66:]] = entry[:64]
+
+    return sha256s
+
+
+_MAX_COMMAND_LENGTH = 64 * 1024
+
+
+def _compare_sha256s(
+    local_dir_path: str,
+    files: list[DirSnapshotFile],
+    remote_sha256s: dict[str, str],
+) -> tuple[list[DirSnapshotFile], list[DirSnapshotFile]]:
+    """
+    Compare the SHA-256 hashes of local files with the hashes of the corresponding remote files,
+    and return the files whose content is the same and the files whose content differs.
+    """
+
+    def hash_local_file(file: DirSnapshotFile) -> str:
+        return hash_file_sha256(os.path.join(local_dir_path, file.path))
+
+    with ThreadPoolExecutor() as executor:
+        local_sha256s = list(executor.map(hash_local_file, files))
+
+    same_files: list[DirSnapshotFile] = []
+    changed_files: list[DirSnapshotFile] = []
+    for file, local_sha256 in zip(files, local_sha256s, strict=True):
+        if remote_sha256s.get(file.path) == local_sha256:
+            same_files.append(file)
+        else:
+            changed_files.append(file)
+
+    return same_files, changed_files
+
+
+def _get_tar_compression_flag(compression: TarCompression | None) -> str:
+    """
+    Get the command line flag of `tar` for a compression format.
+    """
+
+    match compression:
+        case None:
+            return ''
+        case 'gz':
+            return '-z'
+        case 'xz':
+            return '-J'
+        case 'zst':
+            return '--zstd'
+
+
+def _check_ssh_tar_exit_status(channel: Channel, stderr: ChannelFile):
+    """
+    Wait for a remote `tar` command to complete, and raise an exception with its error output if
+    it failed.
+    """
+
+    exit_code = channel.recv_exit_status()
+    if exit_code != 0:
+        error_output = stderr.read().decode('utf-8', errors='replace')
+        raise Exception(f"Remote tar command failed with exit code {exit_code}. Full error:\n{error_output}")
+
+
+@dataclass
+class _SSHSession:
+    """
+    An SSH connection and its SFTP channel, kept alive by an SSH session pool.
+    """
+
+    ssh_client: SSHClient
+    sftp_client: SFTPClient
+    last_used: float
+
+
+def _is_ssh_session_alive(session: _SSHSession) -> bool:
+    """
+    Check whether the connection and the SFTP channel of an SSH session are still open, without
+    any round trip to the server.
+    """
+
+    transport = session.ssh_client.get_transport()
+    return transport is not None and transport.is_active() and not session.sftp_client.sock.closed
+
+
+def _close_ssh_session(session: _SSHSession):
+    """
+    Close an SSH session, ignoring the errors of connections that are already broken.
+    """
+
+    try:
+        session.sftp_client.close()
+    except Exception:
+        pass
+
+    session.ssh_client.close()
+
+
+@contextmanager
+def _open_sftp(ssh_client: SSHClient | SSHSessionPool) -> Generator[SFTPClient, None, None]:
+    """
+    Borrow an SFTP channel from an SSH session pool, or open a new SFTP channel that is closed
+    after use for an SSH client.
+    """
+
+    if isinstance(ssh_client, SSHSessionPool):
+        with ssh_client.sftp() as sftp_client:
+            yield sftp_client
+
+        return
+
+    sftp_client = ssh_client.open_sftp()
+    try:
+        yield sftp_client
+    finally:
+        sftp_client.close()
+
+
+@contextmanager
+def _borrow_ssh_client(ssh_client: SSHClient | SSHSessionPool) -> Generator[SSHClient, None, None]:
+    """
+    Borrow an SSH client from an SSH session pool, or use the SSH client itself.
+    """
 
-        for file_name in sftp_client.listdir(full_remote_path):
-            sub_rel_path = os.path.join(rel_path, file_name)
-            _download_ssh_file_rec_impl(sftp_client, remote_root_path, local_root_path, sub_rel_path)
+    if isinstance(ssh_client, SSHSessionPool):
+        with ssh_client.ssh() as borrowed_ssh_client:
+            yield borrowed_ssh_client
     else:
-        print(f'Downloading file \'{rel_path}\'...')
-        sftp_client.get(full_remote_path, full_local_path)
+        yield ssh_client
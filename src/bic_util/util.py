@@ -1,4 +1,6 @@
-from collections.abc import Callable, Iterable
+from collections import deque
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import Executor, Future
 from datetime import datetime
 from typing import TypeVar
 
@@ -33,6 +35,29 @@ def find_map(predicate: Callable[[T], U | None], iterable: Iterable[T]) -> U | N
     return None
 
 
+def map_bounded(
+    executor: Executor,
+    function: Callable[[T], U],
+    iterable: Iterable[T],
+    max_pending: int,
+) -> Generator[U, None, None]:
+    """
+    Map a function over an iterable using an executor, yielding the results in order. Unlike
+    `Executor.map`, the iterable is consumed lazily and at most `max_pending` calls are submitted
+    at any given time, which keeps the memory usage bounded for very large iterables.
+    """
+
+    pending: deque[Future[U]] = deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+        pending.append(executor.submit(function, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
 def hours_to_seconds(hours: int):
     """
     Convert a number of hours to a number of seconds.